@@ -1,25 +1,48 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-import json
 import os
+import threading
+import time
 
-from flask import Blueprint, abort, request
+from cachetools import LRUCache
+from flask import Blueprint, abort, copy_current_request_context, request
+from mongoengine import Q
+import pymongo
 from pymongo import aggregation
 
-from models import Region, CaseEntry, Prediction, Serotype
+import config
+import cubes
+import generations
+from models import (
+    CaseEntry, DailyCount, FeatureCount, Prediction, Serotype, SerotypeCount,
+)
+import prefix_sums
+import region_index
+import response_cache
+import rollups
+import subregion_maps
+import visibility
 
 bp = Blueprint("data", __name__)
 
+# shared by all requests handled by this worker, so that the number of
+# concurrent database queries (and pymongo connections) stays bounded
+executor = ThreadPoolExecutor(max_workers=config.QUERY_THREADS)
+
+# $dateTrunc arguments of each trends granularity; weeks are ISO weeks
+# starting on Monday, and epi weeks (CDC/MMWR) start on Sunday
+TREND_GRANULARITIES = {
+    "day": {"unit": "day"},
+    "week": {"unit": "week", "startOfWeek": "monday"},
+    "epiweek": {"unit": "week", "startOfWeek": "sunday"},
+    "month": {"unit": "month"},
+}
+
 @bp.route("/query", methods=["POST"])
 def query():
     region_id = request.json.get("region_id")
-    region = Region.objects(region_id=region_id).first()
-
-    breadcrumbs = []
-    for i in range(len(region.parent_ids)):
-        breadcrumbs.append([region.parent_names[i], region.parent_ids[i]])
-        if region.parent_ids[i]==request.tenant.scope_region:
-            break
-    breadcrumbs = breadcrumbs[::-1] + [[region.name, region_id]]
+    region = region_index.get(region_id)
 
     if not region:
         abort(404)
@@ -37,65 +60,155 @@ def query():
         "region_id": region_id,
         "region_name": region.name,
         "region_type": region.region_type,
-        "breadcrumbs": breadcrumbs,
+        "breadcrumbs": region.breadcrumbs_under(request.tenant.scope_region),
         "start_date": start_date_str,
         "end_date": end_date_str,
         "available_stages": request.tenant.stages,
     }
 
     requested_aggregates = request.json.get("aggregates", [])
+    granularity = request.json.get("trends_granularity", "week")
+    if granularity not in TREND_GRANULARITIES:
+        abort(400)
+        return
+
+    cache_key = response_cache.make_key(
+        request.tenant, request.user, region_id,
+        start_date_str, end_date_str, requested_aggregates, granularity,
+    )
+    cached_result = response_cache.get(cache_key)
+    if cached_result is not None:
+        result = cached_result
+    else:
+        cache_version = response_cache.version()
+        result.update(_compute_aggregates(
+            region, start_date, end_date, requested_aggregates, granularity,
+        ))
+        if not result["incomplete_aggregates"]:
+            response_cache.put(
+                cache_key, result, region_id, start_date_str, end_date_str, cache_version,
+            )
+
+    # report files and maps are added independently of data syncs, so are never cached
+    if "reports" in requested_aggregates:
+        result["reports"] = _reports()
+    if all([
+        "subregions_map" in requested_aggregates,
+        region.region_type in request.tenant.splittable_region_types,
+    ]):
+        # the map itself is fetched separately, and cached by the browser
+        result["subregions_map_version"] = subregion_maps.version(region_id)
+    return result
+
+@bp.route("/cache_stats")
+def cache_stats():
+    if "user_management" not in request.user.permissions:
+        abort(401)
+        return
+    return response_cache.stats()
 
+
+def _compute_aggregates(region, start_date, end_date, requested_aggregates, granularity):
+    region_id = region.region_id
+
+    use_rollups = rollups.is_complete()
+
+    tasks = {}
     if "summary" in requested_aggregates:
-        result["summary"] = _summary(region_id, start_date, end_date)
+        tasks["summary"] = (_summary, region_id, start_date, end_date, use_rollups)
 
     if all([
         "subregionwise_distribution" in requested_aggregates,
         region.region_type in request.tenant.splittable_region_types,
     ]):
-        result["subregionwise_distribution"] = _subregionwise_distribution(
-            region, start_date, end_date,
+        tasks["subregionwise_distribution"] = (
+            _subregionwise_distribution, region, start_date, end_date, use_rollups,
         )
 
     if "feature_distributions" in requested_aggregates:
-        result["feature_distributions"] = _feature_distributions(
-            region_id, start_date, end_date,
+        tasks["feature_distributions"] = (
+            _feature_distributions, region_id, start_date, end_date, cubes.is_complete(),
         )
 
     if "trends" in requested_aggregates:
-        result["trends"] = _trends(region_id, start_date, end_date)
+        tasks["trends"] = (
+            _trends, region_id, start_date, end_date, use_rollups, granularity,
+        )
 
     if "predictions" in requested_aggregates:
-        result["predictions"] = _predictions(region_id, start_date, end_date)
-
-    if "reports" in requested_aggregates:
-        result["reports"] = _reports()
-
-    if all([
-        "subregions_geojson" in requested_aggregates,
-        region.region_type in request.tenant.splittable_region_types,
-    ]):
-        filepath = "/".join(["source_files", "geojsons", "subregions", region_id]) + ".geojson"
-        try:
-            with open(filepath) as f:
-                result["subregions_geojson"] = json.loads(f.read())
-                f.close()
-        except:
-            pass
-
-    return result
+        tasks["predictions"] = (_predictions, region_id, start_date, end_date)
+
+    return _run_in_parallel(tasks)
+
+
+def _run_in_parallel(tasks):
+    '''
+    Runs the given aggregates concurrently on the shared thread pool,
+    waiting for them until the request deadline. Aggregates that do
+    not finish in time are returned as None, and are listed under
+    'incomplete_aggregates' so that the response is still usable.
+    '''
+    deadline = time.monotonic() + config.QUERY_DEADLINE_SECONDS
+    futures = {}
+    for name, (fn, *args) in tasks.items():
+        task = copy_current_request_context(_with_deadline(fn, deadline))
+        futures[name] = executor.submit(task, *args)
+
+    done, _ = wait(futures.values(), timeout=config.QUERY_DEADLINE_SECONDS)
+
+    results = {"incomplete_aggregates": []}
+    for name, future in futures.items():
+        if future in done and not _timed_out(future.exception()):
+            results[name] = future.result()
+        else:
+            future.cancel()
+            results[name] = None
+            results["incomplete_aggregates"].append(name)
+    return results
 
+def _with_deadline(fn, deadline):
+    '''
+    Limits the database operations of an aggregate to the time left
+    until the request deadline, which the server enforces with
+    maxTimeMS. Aggregates that time out, or that are still queued at
+    the deadline, then free their thread for the next requests instead
+    of running on after the request has stopped waiting for them.
+    '''
+    def run(*args):
+        remaining = deadline - time.monotonic()
+        if remaining<=0:
+            raise TimeoutError("request deadline passed before the aggregate started")
+        with pymongo.timeout(remaining):
+            return fn(*args)
+    return run
+
+def _timed_out(exception):
+    return isinstance(exception, TimeoutError) or getattr(exception, "timeout", False)
+
+def _summary(region_id, start_date, end_date, use_rollups):
+    index = prefix_sums.current() if use_rollups else None
+    if index:
+        return index.stage_totals([region_id], start_date, end_date, request.tenant.stages)[0]
 
-def _summary(region_id, start_date, end_date):
     grouping_specs = {"_id": None}
     for stage in request.tenant.stages:
         grouping_specs[stage] = {"$sum": f'${stage}'}
 
     query_fields = request.tenant.stages
-    aggregate = CaseEntry.objects(
-        regions = region_id,
-        record_date__gte = start_date,
-        record_date__lte = end_date,
-    ).only(*query_fields).aggregate([{"$group": grouping_specs}])
+    if use_rollups:
+        query = DailyCount.objects(
+            region_id = region_id,
+            date__gte = start_date,
+            date__lte = end_date,
+        )
+    else:
+        query = CaseEntry.objects(
+            __raw__ = visibility.visible(),
+            regions = region_id,
+            record_date__gte = start_date,
+            record_date__lte = end_date,
+        )
+    aggregate = query.only(*query_fields).aggregate([{"$group": grouping_specs}])
 
     result = list(aggregate)
     if result:
@@ -105,25 +218,47 @@ def _summary(region_id, start_date, end_date):
         result = {stage:0 for stage in request.tenant.stages}
     return result
 
-def _subregionwise_distribution(region, start_date, end_date):
-    query_fields = ["regions"] + request.tenant.stages
-    query = CaseEntry.objects(
-        regions = region.region_id,
-        record_date__gte = start_date,
-        record_date__lte = end_date,
-    ).only(*query_fields)
-
-    aggregation_index = request.tenant.subregion_indexes[region.region_type]
-    grouping_specs = {
-        "_id": {"$arrayElemAt": ["$regions", aggregation_index]},
-    }
+def _subregionwise_distribution(region, start_date, end_date, use_rollups):
+    subregion_list = region.children
+
+    index = prefix_sums.current() if use_rollups else None
+    if index:
+        totals = index.stage_totals(
+            [r.region_id for r in subregion_list],
+            start_date, end_date, request.tenant.stages,
+        )
+        return [
+            {"region_id": r.region_id, "name": r.name, **counts}
+            for r, counts in zip(subregion_list, totals)
+        ]
+
+    if use_rollups:
+        query_fields = ["region_id"] + request.tenant.stages
+        query = DailyCount.objects(
+            region_id__in = [r.region_id for r in subregion_list],
+            date__gte = start_date,
+            date__lte = end_date,
+        ).only(*query_fields)
+        grouping_specs = {"_id": "$region_id"}
+    else:
+        query_fields = ["regions"] + request.tenant.stages
+        query = CaseEntry.objects(
+            __raw__ = visibility.visible(),
+            regions = region.region_id,
+            record_date__gte = start_date,
+            record_date__lte = end_date,
+        ).only(*query_fields)
+
+        aggregation_index = request.tenant.subregion_indexes[region.region_type]
+        grouping_specs = {
+            "_id": {"$arrayElemAt": ["$regions", aggregation_index]},
+        }
     for stage in request.tenant.stages:
         grouping_specs[stage] = {"$sum": f'${stage}'}
 
     aggregate = list(query.aggregate([{"$group": grouping_specs}]))
     aggregate_dict = {r["_id"]:r for r in aggregate}
 
-    subregion_list = list(Region.objects(parent_ids__0=region.region_id))
     results = []
     for region in subregion_list:
         row = {"region_id": region.region_id, "name": region.name}
@@ -135,48 +270,90 @@ def _subregionwise_distribution(region, start_date, end_date):
 
 
 
-def _feature_distributions(region_id, start_date, end_date):
-    query = CaseEntry.objects(
-        regions = region_id,
-        record_date__gte = start_date,
-        record_date__lte = end_date,
-        source = "linelists",
-        confirmed__gte = 1,
-    ).only("age_range", "gender")
-
-    age_range_distribution = query.aggregate([
-        {"$group": {
-            "_id": "$age_range",
-            "cases": {"$sum": "$confirmed"}
-        }},
-    ])
-
-    gender_distribution = query.aggregate([
-        {"$group": {
-            "_id": "$gender",
-            "cases": {"$sum": "$confirmed"}
-        }}
-    ])
-
-    test_type_distribution = query.aggregate([
+def _feature_distributions(region_id, start_date, end_date, use_cubes):
+    '''
+    With the cubes, the counts over whole weeks are read from the
+    feature and serotype cubes, and only the days before and after
+    these are counted from the raw records. Tenant specific features
+    are not part of the cube, and are always counted from raw records.
+    '''
+    features = list(cubes.FEATURES)
+    extra_features = request.tenant.extra_feature_distributions
+    date_query = Q(record_date__gte=start_date, record_date__lte=end_date)
+
+    first_week, end_week = cubes.full_weeks(start_date, end_date)
+    if not use_cubes or first_week>=end_week:
+        distributions = _line_list_distributions(region_id, date_query, features + extra_features)
+        distributions["serotype"] = list(_serotype_distribution(region_id, date_query))
+        return distributions
+
+    edge_query = (
+        Q(record_date__gte=start_date, record_date__lt=first_week)
+        | Q(record_date__gte=end_week, record_date__lte=end_date)
+    )
+    distributions = _line_list_distributions(region_id, edge_query, features)
+
+    feature_counts = FeatureCount.objects(
+        region_id = region_id,
+        week__gte = first_week,
+        week__lt = end_week,
+    )
+    cube_distributions = _facet_counts(feature_counts, features)
+    for feature in features:
+        distributions[feature] = _merge_counts(distributions[feature], cube_distributions[feature])
+
+    if extra_features:
+        distributions.update(_line_list_distributions(region_id, date_query, extra_features))
+
+    serotype_counts = SerotypeCount.objects(
+        region_id = region_id,
+        week__gte = first_week,
+        week__lt = end_week,
+    ).aggregate([
         {"$group": {
-            "_id": "$test_type",
-            "cases": {"$sum": "$confirmed"}
+            "_id": "$serotype",
+            "cases": {"$sum": "$count"}
         }}
     ])
+    distributions["serotype"] = _merge_counts(
+        _serotype_distribution(region_id, edge_query), serotype_counts,
+    )
+    return distributions
 
-    return {
-        "age_range": list(age_range_distribution),
-        "gender": list(gender_distribution),
-        "test_type": list(test_type_distribution),
-        "serotype": list(_serotype_distribution(region_id, start_date, end_date)),
-    }
-
-def _serotype_distribution(region_id, start_date, end_date):
+def _line_list_distributions(region_id, date_query, features):
+    query = CaseEntry.objects(
+        date_query,
+        __raw__ = visibility.visible(),
+        regions = region_id,
+        source = "linelists",
+        confirmed__gte = 1,
+    ).only(*features)
+    return _facet_counts(query, features)
+
+def _facet_counts(query, features):
+    # all distributions are computed from a single scan of the query
+    facets = {}
+    for feature in features:
+        facets[feature] = [{"$group": {
+            "_id": f'${feature}',
+            "cases": {"$sum": "$confirmed"},
+        }}]
+
+    result = list(query.aggregate([{"$facet": facets}]))
+    return result[0] if result else {feature: [] for feature in features}
+
+def _merge_counts(*distributions):
+    cases = defaultdict(int)
+    for distribution in distributions:
+        for row in distribution:
+            cases[row["_id"]] += row["cases"]
+    return [{"_id": key, "cases": count} for key, count in cases.items() if count]
+
+def _serotype_distribution(region_id, date_query):
     query = Serotype.objects(
+        date_query,
+        __raw__ = visibility.visible(),
         regions = region_id,
-        record_date__gte = start_date,
-        record_date__lte = end_date,
     ).only("serotype")
 
     return query.aggregate([
@@ -188,48 +365,80 @@ def _serotype_distribution(region_id, start_date, end_date):
 
 
 
-def _trends(region_id, start_date, end_date):
-    start_monday = start_date - timedelta(days=start_date.weekday())
-    end_sunday = end_date + timedelta(days=6-end_date.weekday())
+def _bucket_bounds(start_date, end_date, granularity):
+    # start of the first bucket, and end (exclusive) of the last one
+    if granularity=="day":
+        return start_date, end_date + timedelta(days=1)
+    if granularity=="month":
+        end_month = end_date.replace(day=1) + timedelta(days=32)
+        return start_date.replace(day=1), end_month.replace(day=1)
 
-    labels = {}
-    date = start_monday
-    while date<end_sunday:
-        labels[date.isoformat().split("T")[0]] = {"confirmed": 0, "tested": 0}
-        date += timedelta(days=7)
+    if granularity=="week":
+        start_offset, end_offset = start_date.weekday(), end_date.weekday()
+    else:
+        start_offset, end_offset = (start_date.weekday()+1)%7, (end_date.weekday()+1)%7
+    return start_date - timedelta(days=start_offset), end_date + timedelta(days=7-end_offset)
 
-    query = CaseEntry.objects(
-        regions = region_id,
-        record_date__gte = start_monday,
-        record_date__lte = end_sunday,
-    ).only("tested", "confirmed")
+def _trends(region_id, start_date, end_date, use_rollups, granularity):
+    bucket_start, bucket_end = _bucket_bounds(start_date, end_date, granularity)
+
+    if use_rollups:
+        query = DailyCount.objects(
+            region_id = region_id,
+            date__gte = bucket_start,
+            date__lt = bucket_end,
+        )
+        date_field = "$date"
+    else:
+        query = CaseEntry.objects(
+            __raw__ = visibility.visible(),
+            regions = region_id,
+            record_date__gte = bucket_start,
+            record_date__lt = bucket_end,
+        )
+        date_field = "$record_date"
 
-    aggregate = query.aggregate([
+    truncation = dict(date=date_field, **TREND_GRANULARITIES[granularity])
+    aggregate = query.only("tested", "confirmed").aggregate([
         {"$group": {
-            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date":"$record_date"}},
+            "_id": {"$dateTrunc": truncation},
             "tested": {"$sum": "$tested"},
             "confirmed": {"$sum": "$confirmed"},
         }},
-        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "date": "$_id", "tested": 1, "confirmed": 1}},
+        # buckets without any records are filled in as zeros
+        {"$densify": {
+            "field": "date",
+            "range": {
+                "step": 1,
+                "unit": truncation["unit"],
+                "bounds": [bucket_start, bucket_end],
+            },
+        }},
+        {"$sort": {"date": 1}},
+        {"$project": {
+            "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$date"}},
+            "confirmed": {"$ifNull": ["$confirmed", 0]},
+            "tested": {"$ifNull": ["$tested", 0]},
+        }},
     ])
-
-    records = list(aggregate)
-    for record in records:
-        date = datetime(*map(int, record["_id"].split("-")))
-        week_start_date = date - timedelta(days=date.weekday())
-        label = week_start_date.isoformat().split("T")[0]
-        labels[label]["confirmed"] += record["confirmed"]
-        labels[label]["tested"] += record["tested"]
-
-    results = []
-    for label in sorted(labels.keys()):
-        results.append({
-            "date": label,
-            "confirmed": labels[label]["confirmed"],
-            "tested": labels[label]["tested"]
-        })
+    results = list(aggregate)
+
+    # $densify only fills in buckets once it has received a document
+    if not results:
+        date = bucket_start
+        while date<bucket_end:
+            results.append({"date": date.strftime("%Y-%m-%d"), "confirmed": 0, "tested": 0})
+            date = _next_bucket(date, granularity)
     return results
 
+def _next_bucket(date, granularity):
+    if granularity=="day":
+        return date + timedelta(days=1)
+    if granularity=="month":
+        return (date + timedelta(days=32)).replace(day=1)
+    return date + timedelta(days=7)
+
 def _predictions(parent_id, start_date, end_date):
 
     if "predictions" not in request.user.permissions:
@@ -243,29 +452,19 @@ def _predictions(parent_id, start_date, end_date):
         end_sunday + timedelta(days=22),
     ]
 
-    subregion_list = list(Region.objects(parent_ids__0=parent_id))
+    prediction_sets = _prediction_sets(parent_id, prediction_dates)
+    subregion_list = region_index.get(parent_id).children
     results = []
     for date in prediction_dates:
+        prediction_set = prediction_sets[date]
         date_obj = {
             "date": date.isoformat().split("T")[0],
-            "prediction": {},
+            "prediction": prediction_set["prediction"],
             "subregions": [],
         }
-        parent_prediction = Prediction.objects(region_id=parent_id, date=date).first()
-        date_obj["prediction"] = {
-            "zone": parent_prediction.prediction_zone if parent_prediction else -2,
-            "value": parent_prediction.prediction if parent_prediction else -0,
-        }
-
-        predictions_dict = {}
-        for p in Prediction.objects(parent_id=parent_id, date=date):
-            predictions_dict[p.region_id] =  {
-                "zone": p.prediction_zone,
-                "value": p.prediction,
-            }
 
         for region in subregion_list:
-            p = predictions_dict.get(region.region_id, {})
+            p = prediction_set["subregions"].get(region.region_id, {})
             date_obj["subregions"].append({
                 "region_id": region.region_id,
                 "name": region.name,
@@ -275,6 +474,54 @@ def _predictions(parent_id, start_date, end_date):
         results.append(date_obj)
     return results
 
+# (parent_id, date) -> predictions for the parent and its subregions,
+# cleared whenever predictions are imported or deleted
+_prediction_cache = LRUCache(maxsize=10000)
+_prediction_cache_generation = None
+_prediction_cache_lock = threading.Lock()
+
+def _prediction_sets(parent_id, dates):
+    global _prediction_cache_generation
+
+    with _prediction_cache_lock:
+        generation = generations.get("predictions")
+        if generation!=_prediction_cache_generation:
+            _prediction_cache.clear()
+            _prediction_cache_generation = generation
+        results = {}
+        for date in dates:
+            if (parent_id, date) in _prediction_cache:
+                results[date] = _prediction_cache[(parent_id, date)]
+
+    missing_dates = [date for date in dates if date not in results]
+    if not missing_dates:
+        return results
+
+    for date in missing_dates:
+        results[date] = {
+            "prediction": {"zone": -2, "value": 0},
+            "subregions": {},
+        }
+    query = Prediction.objects(
+        Q(region_id=parent_id, date__in=missing_dates)
+        | Q(parent_id=parent_id, date__in=missing_dates)
+    ).only("region_id", "date", "prediction", "prediction_zone").as_pymongo()
+    for p in query:
+        prediction = {
+            "zone": p.get("prediction_zone", -2),
+            "value": p.get("prediction", 0),
+        }
+        if p["region_id"]==parent_id:
+            results[p["date"]]["prediction"] = prediction
+        else:
+            results[p["date"]]["subregions"][p["region_id"]] = prediction
+
+    with _prediction_cache_lock:
+        if generation==_prediction_cache_generation:
+            for date in missing_dates:
+                _prediction_cache[(parent_id, date)] = results[date]
+    return results
+
 def _reports():
     if "report_download" in request.user.permissions:
         return sorted(os.listdir("source_files/reports/" + request.tenant.tenant_id))
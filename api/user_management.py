@@ -1,5 +1,6 @@
 from flask import Blueprint, abort, request
 
+import generations
 from models import User
 
 bp = Blueprint("users", __name__)
@@ -48,6 +49,7 @@ def add_user():
             home_region = data["home_region"],
         )
         user.save()
+        generations.bump("users")
         return {"message": "User Added Successfully"}
 
 @bp.route("/delete_user", methods=["POST"])
@@ -72,4 +74,5 @@ def delete_user():
         return {"message": "Cannot Delete User Admin"}
 
     user.delete()
+    generations.bump("users")
     return {"message": "User Deleted"}
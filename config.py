@@ -11,6 +11,30 @@ FLASK_SECRET_KEY = env["FLASK_SECRET_KEY"]
 JWT_SECRET = env["JWT_SECRET"]
 MIXPANEL_PROJECT_TOKEN = env["MIXPANEL_PROJECT_TOKEN"]
 
+# threads per worker used for running dashboard aggregates in parallel,
+# and the time after which a query responds with the ones that are ready
+QUERY_THREADS = int(env.get("QUERY_THREADS") or 8)
+QUERY_DEADLINE_SECONDS = float(env.get("QUERY_DEADLINE_SECONDS") or 20)
+
+# size limit of the query response cache shared by all workers
+RESPONSE_CACHE_MAX_MB = int(env.get("RESPONSE_CACHE_MAX_MB") or 256)
+
+# no. of rows written to the database at once while importing data files
+IMPORT_BATCH_SIZE = int(env.get("IMPORT_BATCH_SIZE") or 1000)
+
+# records hidden by imports are deleted in batches of this size,
+# with a pause in between to limit the load on the database
+GC_BATCH_SIZE = int(env.get("GC_BATCH_SIZE") or 1000)
+GC_PAUSE_SECONDS = float(env.get("GC_PAUSE_SECONDS") or 0.5)
+
+# records of import ids that were never activated, e.g. because the
+# import failed, are deleted once the import id is this old
+GC_ABANDONED_IMPORT_HOURS = float(env.get("GC_ABANDONED_IMPORT_HOURS") or 24)
+
+# time for which a logged in user's permissions are cached per worker,
+# unless they are changed through the admin page or scripts earlier
+USER_CACHE_TTL_SECONDS = float(env.get("USER_CACHE_TTL_SECONDS") or 60)
+
 if ENV_TYPE=="dev":
     import os
     os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
@@ -28,6 +52,12 @@ class Tenant:
     # will be displayed on the dashboard UI
     dashboard_title = DEFAULT_DASHBOARD_TITLE
 
+    # case entry fields, in addition to age_range, gender and test_type,
+    # for which distributions of confirmed line list cases are shown;
+    # these must be fields of models.CaseEntry, since other columns of
+    # the case data files are not imported, and are checked on startup
+    extra_feature_distributions = []
+
     # Earliest date for which data is available
     data_start_date = datetime(2000, 1, 1)
 
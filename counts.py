@@ -0,0 +1,104 @@
+from pymongo import UpdateOne
+
+import generations
+from models import SourceFile
+import visibility
+
+WRITE_BATCH_SIZE = 1000
+
+def region_ids(entry):
+    # regions a record is counted under, once each
+    return set(entry["regions"]) - {"admin_0", ""}
+
+def write(document_class, key_fields, deltas):
+    '''
+    Adds the deltas, a dict of key -> {field: count}, to the counts in
+    the documents with the given key fields, creating those that do
+    not exist. Returns the no. of documents written.
+    '''
+    operations = []
+    for key, counts in deltas.items():
+        if not any(counts.values()):
+            continue
+        operations.append(UpdateOne(
+            dict(zip(key_fields, key)),
+            {"$inc": counts},
+            upsert = True,
+        ))
+
+    collection = document_class._get_collection()
+    for i in range(0, len(operations), WRITE_BATCH_SIZE):
+        collection.bulk_write(operations[i:i+WRITE_BATCH_SIZE], ordered=False)
+    return len(operations)
+
+def unwind_regions_pipeline(fields, group_id, sums):
+    '''
+    Aggregation stages which group records by each distinct region they
+    fall under, along with the group_id expressions, and add up the
+    sums. fields are the record fields these refer to.
+    '''
+    return [
+        {"$project": dict(
+            regions = {"$setUnion": ["$regions", []]},
+            **{field: 1 for field in fields},
+        )},
+        {"$unwind": "$regions"},
+        {"$match": {"regions": {"$nin": ["admin_0", ""]}}},
+        {"$group": dict(_id=dict(region_id="$regions", **group_id), **sums)},
+    ]
+
+def source_records(document_class, source, **filters):
+    # the visible records of a source file
+    if source.import_ids:
+        return document_class.objects(
+            __raw__ = visibility.visible(source.import_ids),
+            source_filename = source.name,
+            **filters,
+        )
+    # files imported before import ids were introduced
+    return document_class.objects(source_filename=source.name, import_id=None, **filters)
+
+def rebuild(document_class, query, pipeline, key_fields, count_fields):
+    '''
+    Replaces the documents with the counts of the records matched by
+    the query, grouped by the pipeline, on the database server.
+    '''
+    document_class.objects().delete()
+    document_class.ensure_indexes()
+
+    projection = {"_id": 0}
+    for field in key_fields:
+        projection[field] = f'$_id.{field}'
+    for field in count_fields:
+        projection[field] = 1
+
+    query.aggregate(pipeline + [
+        {"$project": projection},
+        {"$merge": {
+            "into": document_class._get_collection_name(),
+            "on": list(key_fields),
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }},
+    ], allowDiskUse=True)
+
+_all_sources = {}
+
+def all_sources(data_types, flag):
+    '''
+    Whether every file of the data types has the flag set. The result
+    is cached per process until the 'sources' generation marker is
+    bumped, which every change to the flags does.
+    '''
+    key = (tuple(data_types), flag)
+    generation = generations.get("sources")
+    cached = _all_sources.get(key)
+    if cached and cached[0]==generation:
+        return cached[1]
+
+    pending = SourceFile.objects(
+        data_type__in = list(data_types),
+        **{flag + "__ne": True},
+    ).only("id").first()
+    _all_sources[key] = (generation, pending is None)
+    return pending is None
@@ -0,0 +1,109 @@
+from collections import defaultdict
+from datetime import timedelta
+
+import counts
+import generations
+from models import CaseEntry, FeatureCount, Serotype, SerotypeCount, SourceFile
+import visibility
+
+FEATURES = ("age_range", "gender", "test_type")
+FEATURE_KEY_FIELDS = ("region_id", "week") + FEATURES
+SEROTYPE_KEY_FIELDS = ("region_id", "week", "serotype")
+
+def week_start(date):
+    return date - timedelta(days=date.weekday())
+
+def full_weeks(start_date, end_date):
+    '''
+    Returns the first and the last (exclusive) week start dates of the
+    whole weeks between the two dates. The days before and after these
+    are not covered by the cubes.
+    '''
+    return week_start(start_date + timedelta(days=6)), week_start(end_date + timedelta(days=1))
+
+def new_deltas():
+    '''
+    Returns an accumulator of feature and serotype cube counts, to be
+    filled using add_entry and add_serotype, and written using apply.
+    '''
+    return {"features": defaultdict(int), "serotypes": defaultdict(int)}
+
+def add_entry(deltas, entry, sign=1):
+    # feature distributions only count confirmed cases in line lists
+    if entry["source"]!="linelists" or (entry["confirmed"] or 0)<1:
+        return
+    key = (week_start(entry["record_date"]),) + tuple(entry[f] for f in FEATURES)
+    for region_id in counts.region_ids(entry):
+        deltas["features"][(region_id,) + key] += sign * entry["confirmed"]
+
+def add_serotype(deltas, entry, sign=1):
+    week = week_start(entry["record_date"])
+    for region_id in counts.region_ids(entry):
+        deltas["serotypes"][(region_id, week, entry["serotype"])] += sign
+
+def apply(deltas):
+    counts.write(FeatureCount, FEATURE_KEY_FIELDS, {
+        key: {"confirmed": count} for key, count in deltas["features"].items()
+    })
+    counts.write(SerotypeCount, SEROTYPE_KEY_FIELDS, {
+        key: {"count": count} for key, count in deltas["serotypes"].items()
+    })
+
+def _unwind_regions_pipeline(fields, sums):
+    # a record is counted once for each distinct region it falls under
+    return counts.unwind_regions_pipeline(
+        ("record_date", "confirmed") + tuple(fields),
+        dict(
+            week = {"$dateTrunc": {"date": "$record_date", "unit": "week", "startOfWeek": "monday"}},
+            **{field: f'${field}' for field in fields},
+        ),
+        sums,
+    )
+
+def _feature_pipeline():
+    return _unwind_regions_pipeline(FEATURES, {"confirmed": {"$sum": "$confirmed"}})
+
+def _serotype_pipeline():
+    return _unwind_regions_pipeline(["serotype"], {"count": {"$sum": 1}})
+
+def add_source(deltas, source, sign=1):
+    '''
+    Adds the visible records of the given case data or serotype file to
+    the deltas, used with sign=-1 when its records are hidden.
+    '''
+    if source.data_type=="case_data":
+        query = counts.source_records(CaseEntry, source, source="linelists", confirmed__gte=1)
+        pipeline, key_fields, count_field = _feature_pipeline(), FEATURE_KEY_FIELDS, "confirmed"
+        cells = deltas["features"]
+    else:
+        query = counts.source_records(Serotype, source)
+        pipeline, key_fields, count_field = _serotype_pipeline(), SEROTYPE_KEY_FIELDS, "count"
+        cells = deltas["serotypes"]
+
+    for row in query.aggregate(pipeline):
+        cells[tuple(row["_id"][field] for field in key_fields)] += sign * row[count_field]
+
+def is_complete():
+    '''
+    The cubes can be used in place of raw records only if every case
+    data and serotype file has been added to them.
+    '''
+    return counts.all_sources(["case_data", "serotype"], "in_cubes")
+
+def rebuild():
+    '''
+    Recomputes both cubes from the visible raw records on the database
+    server. Used when setting up the cubes on an existing database.
+    '''
+    query = CaseEntry.objects(
+        __raw__ = visibility.visible(),
+        source = "linelists",
+        confirmed__gte = 1,
+    )
+    counts.rebuild(FeatureCount, query, _feature_pipeline(), FEATURE_KEY_FIELDS, ["confirmed"])
+
+    query = Serotype.objects(__raw__=visibility.visible())
+    counts.rebuild(SerotypeCount, query, _serotype_pipeline(), SEROTYPE_KEY_FIELDS, ["count"])
+
+    SourceFile.objects(data_type__in=["case_data", "serotype"]).update(in_cubes=True)
+    generations.bump("sources")
@@ -8,9 +8,12 @@ import google_auth_oauthlib.flow
 from api.data import bp as data_api_blueprint
 from api.user_management import bp as user_management_api_blueprint
 import config
-from models import CaseEntry, Region, User
+from models import User
+import region_index
 import region_search
+import subregion_maps
 from tenants import get_tenant_for_domain
+import user_cache
 
 app = Flask(__name__, template_folder="templates")
 app.secret_key = config.FLASK_SECRET_KEY
@@ -18,7 +21,7 @@ app.register_blueprint(data_api_blueprint, url_prefix="/api/data")
 app.register_blueprint(user_management_api_blueprint, url_prefix="/api/users")
 CSRFProtect(app)
 
-region_search.init()
+region_index.load()
 
 @app.context_processor
 def inject_template_globals():
@@ -31,7 +34,12 @@ def request_preprocessor():
     if not request.tenant:
         return f'DOMAIN {domain} NOT CONFIGURED'
 
-    request.user = User.get_by_jwt(
+    # static assets are served to everyone
+    if request.path.startswith("/static"):
+        request.user = None
+        return
+
+    request.user = user_cache.get_by_jwt(
         request.cookies.get("auth"),
         request.tenant.tenant_id,
     )
@@ -39,7 +47,6 @@ def request_preprocessor():
     if not any([
         request.user,
         request.path.startswith("/login"),
-        request.path.startswith("/static"),
         "google" in request.path,
     ]):
         return redirect("/login")
@@ -54,15 +61,15 @@ def admin():
 
 @app.route("/region/<region_id>")
 def dashboard_page(region_id):
-    region = Region.objects(region_id=region_id).first()
+    region = region_index.get(region_id)
     if not region:
         abort(404)
     else:
-        last_case_entry = CaseEntry.objects(regions=region_id).order_by("-record_date").first()
-
         last_recorded_case_date = datetime.utcnow().isoformat().split("T")[0]
-        if last_case_entry:
-            last_recorded_case_date = last_case_entry.record_date.isoformat().split("T")[0]
+        first_recorded_case_date = ""
+        if region.last_record_date:
+            last_recorded_case_date = region.last_record_date.isoformat().split("T")[0]
+            first_recorded_case_date = region.first_record_date.isoformat().split("T")[0]
 
         components = [
             "summary",
@@ -94,6 +101,7 @@ def dashboard_page(region_id):
             "index.html",
             tenant = request.tenant,
             latest_date = last_recorded_case_date,
+            earliest_date = first_recorded_case_date,
             components = components,
             grid_template = grid_template,
             grid_template_rows = grid_template_rows,
@@ -102,15 +110,37 @@ def dashboard_page(region_id):
 @app.route("/maps/subregions/<region_id>")
 def subregion_map(region_id):
     region_id = region_id.replace("/", "")
-    region = Region.objects(region_id=region_id).first()
+    region = region_index.get(region_id)
     if not region:
         abort(404)
         return
 
-    if region.in_scope(request.tenant.scope_region):
-        return send_file("/".join(["source_files", "geojsons", "subregions", region_id]) + ".geojson")
-    else:
+    if not region.in_scope(request.tenant.scope_region):
         abort(401)
+        return
+
+    version = subregion_maps.version(region_id)
+    if not version:
+        abort(404)
+        return
+
+    # each encoding is a separate representation, with its own etag
+    filepath, encoding = subregion_maps.variant(region_id, request.accept_encodings)
+    response = send_file(
+        filepath,
+        mimetype = "application/json",
+        etag = version + ("-" + encoding if encoding else ""),
+    )
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+
+    # versioned urls never change, others are revalidated using the etag
+    if request.args.get("v")==version:
+        response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 @app.route("/download_report/<filename>")
 def download_report(filename):
@@ -130,7 +160,10 @@ def region_search_fn():
     q = request.args.get("q")
     if not q:
         return {"results": []}
-    return region_search.search(request.tenant.tenant_id, q)
+    return region_search.search(
+        request.tenant.tenant_id, q,
+        home_region = request.user.home_region,
+    )
 
 
 @app.route("/login")
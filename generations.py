@@ -0,0 +1,27 @@
+import os
+import time
+
+GENERATIONS_DIR = "cache/generations/"
+os.makedirs(GENERATIONS_DIR, exist_ok=True)
+
+def get(name):
+    '''
+    Returns the current value of a named generation marker, which is
+    shared by all processes on this machine through the filesystem.
+    In-process caches store the value they were built at, and are
+    stale once it changes.
+    '''
+    try:
+        with open(GENERATIONS_DIR + name) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+def bump(name):
+    # time based values are unique even when two processes bump together
+    value = str(time.time_ns())
+    tmp_filepath = f'{GENERATIONS_DIR}{name}.{os.getpid()}.tmp'
+    with open(tmp_filepath, "w") as f:
+        f.write(value)
+    os.replace(tmp_filepath, GENERATIONS_DIR + name)
+    return value
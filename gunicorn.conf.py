@@ -0,0 +1,54 @@
+import gc
+import os
+import resource
+import time
+
+from mongoengine import connect, disconnect
+
+import config
+
+# The app is loaded once in the master process, along with the region
+# index and autocompleters loaded below, and the forked workers share
+# this memory copy-on-write instead of each loading their own copies.
+preload_app = True
+
+def _rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _private_mb():
+    # memory not shared with the master, where available (linux)
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            lines = [line.split() for line in f]
+    except OSError:
+        return float("nan")
+    return sum(int(l[1]) for l in lines if l[0] in ("Private_Clean:", "Private_Dirty:")) / 1024
+
+def when_ready(server):
+    import region_search
+
+    start_time = time.time()
+    region_search.init()
+    server.log.info(
+        "Loaded autocompleters in %.2fs, master using %.1f MB",
+        time.time() - start_time, _rss_mb(),
+    )
+
+    # pymongo clients are not fork-safe, so the connection used to load
+    # the region index is closed before forking, and each worker opens
+    # its own
+    disconnect()
+
+    # objects loaded so far are left out of garbage collection, which
+    # would otherwise write to (and so copy) their pages in every worker
+    gc.freeze()
+
+def post_fork(server, worker):
+    worker.fork_time = time.time()
+    connect(host=config.DB_URI)
+
+def post_worker_init(worker):
+    worker.log.info(
+        "Worker %s started in %.2fs, using %.1f MB not shared with the master",
+        os.getpid(), time.time() - worker.fork_time, _private_mb(),
+    )
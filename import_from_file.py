@@ -1,17 +1,449 @@
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
+import gzip
+import hashlib
+import json
+import time
 import traceback
 
-from models import CaseEntry, Prediction, Region, SourceFile, Serotype
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import config
+import cubes
+import generations
+from models import (
+    CaseEntry, Prediction, RecordOwner, Region, RetiredImport, SourceFile, Serotype,
+)
+import response_cache
+import rollups
+import visibility
+
+DUPLICATE_KEY_ERROR = 11000
 
 def _read_csv(filepath):
-    rows = []
-    with open(filepath) as f:
+    '''
+    Yields (line_number, row) pairs from the file one at a time, so
+    that files are never held in memory whole. Files ending with .gz
+    are decompressed while reading.
+    '''
+    if filepath.endswith(".gz"):
+        f = gzip.open(filepath, "rt", newline="")
+    else:
+        f = open(filepath, newline="")
+
+    with f:
+        line_number = 1
         for row in csv.DictReader(f):
-            rows.append(row)
-    return rows
+            line_number += 1
+            yield line_number, row
+
+def _regions(row):
+    return [
+        row.get("location.admin1.ID", "admin_0"),
+        row.get("location.admin2.ID", "admin_0"),
+        row.get("location.admin3.ID", "admin_0"),
+        row.get("location.admin4.ID", "admin_0"),
+        row.get("location.admin5.ID", "admin_0"),
+    ]
+
+def _bulk_import(
+    filename, document_class, to_document,
+    on_written=None, batch_size=None, write_batch=None, import_id=None,
+):
+    '''
+    Streams the file through the read, convert, batch and write stages
+    below, so memory use depends on the batch size and not on the file
+    size. Rows which fail conversion or writing are returned as import
+    errors along with their line numbers. on_written is called with
+    each list of documents that were written.
+
+    Batches are inserted by default, write_batch can be passed to write
+    them differently. It has the same signature as _insert_batch. If an
+    import_id is given, it is set on every document.
+    '''
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    write_batch = write_batch or _insert_batch
+    collection = document_class._get_collection()
+    start_time = time.time()
+
+    errors = []
+    rows = _read_csv(filename)
+    converted_rows = _convert(rows, to_document, filename, errors, import_id)
+    batches = _batches(converted_rows, batch_size)
+    row_count = _write_batches(collection, batches, write_batch, errors, on_written)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f'Imported {row_count} rows in {elapsed:.1f}s ({row_count/elapsed:.0f} rows/s)')
+    return errors
+
+def _convert(rows, to_document, filename, errors, import_id=None):
+    for line_number, row in rows:
+        try:
+            document = to_document(row, filename)
+            if import_id:
+                document["import_id"] = import_id
+            yield line_number, row, document
+        except Exception:
+            error = traceback.format_exc()
+            errors.append({"line_number": line_number, "error": error, "row": row})
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch)>=batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _write_batches(collection, batches, write_batch, errors, on_written=None):
+    row_count = 0
+    for batch in batches:
+        written = write_batch(collection, batch, errors)
+        if on_written:
+            on_written(written)
+        row_count += len(batch)
+    return row_count
+
+def _insert_batch(collection, batch, errors):
+    documents = [document for _, _, document in batch]
+    try:
+        collection.insert_many(documents, ordered=False)
+        return documents
+    except BulkWriteError as e:
+        # with unordered inserts, every document without an error is written
+        failed = {}
+        for write_error in e.details["writeErrors"]:
+            failed[write_error["index"]] = write_error["errmsg"]
+
+        written = []
+        for i, (line_number, row, document) in enumerate(batch):
+            if i in failed:
+                errors.append({"line_number": line_number, "error": failed[i], "row": row})
+            else:
+                written.append(document)
+        return written
+
+def _claim_record_ids(collection, batch):
+    '''
+    Claims the record ids of the batch for its file, and returns
+    record_id -> filename of those already claimed by other files.
+    '''
+    filename = batch[0][2]["source_filename"]
+    record_ids = list({document["record_id"] for _, _, document in batch})
+    owners = RecordOwner._get_collection()
+    operations = []
+    for record_id in record_ids:
+        operations.append(UpdateOne(
+            {"record_collection": collection.name, "record_id": record_id},
+            {"$setOnInsert": {"source_filename": filename, "claimed_at": datetime.utcnow()}},
+            upsert = True,
+        ))
+    try:
+        owners.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # concurrent claims of a new record id collide on the unique
+        # index, and the losing file finds the winner's claim below
+        if any(error["code"]!=DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+            raise
+
+    query = owners.find(
+        {
+            "record_collection": collection.name,
+            "record_id": {"$in": record_ids},
+            "source_filename": {"$ne": filename},
+        },
+        {"record_id": 1, "source_filename": 1},
+    )
+    return {owner["record_id"]: owner["source_filename"] for owner in query}
+
+def _release_record_ids(collection, filename, record_ids=None):
+    query = {"record_collection": collection.name, "source_filename": filename}
+    if record_ids is not None:
+        query["record_id"] = {"$in": list(record_ids)}
+    RecordOwner._get_collection().delete_many(query)
+
+def _insert_unique_batch(collection, batch, errors):
+    '''
+    Inserts the batch like _insert_batch, except for the records whose
+    record_id belongs to another file, which are returned as import
+    errors. The unique index of the records only covers record ids
+    within an import, since a file's records are rewritten under new
+    import ids, so record ids are claimed per file in RecordOwner.
+    '''
+    other_filenames = _claim_record_ids(collection, batch)
 
-def case_data(filename):
+    unique_batch = []
+    for line_number, row, document in batch:
+        other_filename = other_filenames.get(document["record_id"])
+        if other_filename:
+            error = "Duplicate record id, already imported from " + other_filename
+            errors.append({"line_number": line_number, "error": error, "row": row})
+        else:
+            unique_batch.append((line_number, row, document))
+    if not unique_batch:
+        return []
+    return _insert_batch(collection, unique_batch, errors)
+
+def _row_hash(row):
+    return hashlib.sha1(json.dumps(list(row.items())).encode()).hexdigest()
+
+def _update_rows(
+    filename, document_class, to_document, import_ids, import_id,
+    on_written=None, on_removed=None, batch_size=None,
+):
+    '''
+    Brings the records imported earlier from the file, under the given
+    import_ids, in line with its current contents by matching rows with
+    records on their record_id and comparing row hashes, one batch of
+    rows at a time. Added and changed rows are written under the new
+    import_id, while the earlier records of changed and removed rows are
+    marked as superseded by it. Neither is visible until the new
+    import_id is activated. Rows repeating a record id of an earlier
+    row are returned as import errors.
+
+    on_written and on_removed are called with each list of records that
+    were written or superseded.
+    '''
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    collection = document_class._get_collection()
+    start_time = time.time()
+    visible_query = {"source_filename": filename, **visibility.visible(import_ids)}
+
+    # only the record ids of the rows are kept in memory, to find the
+    # repeated ones, and the records of rows removed from the file
+    seen_record_ids = set()
+    written_count, removed_count = 0, 0
+    errors = []
+    rows = _read_csv(filename)
+    converted_rows = _convert(rows, to_document, filename, errors, import_id)
+    for batch in _batches(converted_rows, batch_size):
+        changed_batch, changed_records = _changed_rows(
+            collection, visible_query, batch, seen_record_ids, errors,
+        )
+        if not changed_batch:
+            continue
+        written = _insert_unique_batch(collection, changed_batch, errors)
+        if on_written:
+            on_written(written)
+        written_count += len(written)
+
+        # earlier records of changed rows are superseded only
+        # if the changed row was written successfully
+        superseded_ids = [
+            changed_records[document["record_id"]]
+            for document in written
+            if document["record_id"] in changed_records
+        ]
+        _supersede(collection, superseded_ids, import_id, on_removed)
+
+    # records whose record id is no longer present in the file
+    query = collection.find(visible_query, {"record_id": 1})
+    removed_records = (record for record in query if record["record_id"] not in seen_record_ids)
+    for batch in _batches(removed_records, batch_size):
+        _supersede(collection, [record["_id"] for record in batch], import_id, on_removed)
+        _release_record_ids(collection, filename, [record["record_id"] for record in batch])
+        removed_count += len(batch)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(
+        f'Wrote {written_count} added or changed rows, and removed',
+        f'{removed_count} rows in {elapsed:.1f}s',
+    )
+    return errors
+
+def _changed_rows(collection, visible_query, batch, seen_record_ids, errors):
+    '''
+    Returns the rows of the batch which were added or changed since the
+    file was imported, along with record_id -> _id of the earlier
+    records of the changed rows.
+    '''
+    query = collection.find(
+        {"record_id": {"$in": [document["record_id"] for _, _, document in batch]}, **visible_query},
+        {"record_id": 1, "row_hash": 1},
+    )
+    existing_records = {record["record_id"]: record for record in query}
+
+    changed_batch, changed_records = [], {}
+    for line_number, row, document in batch:
+        record_id = document["record_id"]
+        if record_id in seen_record_ids:
+            error = "Duplicate record id, repeated in the file"
+            errors.append({"line_number": line_number, "error": error, "row": row})
+            continue
+        seen_record_ids.add(record_id)
+
+        existing_record = existing_records.get(record_id)
+        if not existing_record:
+            changed_batch.append((line_number, row, document))
+        elif existing_record.get("row_hash")!=document["row_hash"]:
+            changed_records[record_id] = existing_record["_id"]
+            changed_batch.append((line_number, row, document))
+    return changed_batch, changed_records
+
+def _supersede(collection, ids, import_id, on_removed=None):
+    if not ids:
+        return
+    if on_removed:
+        on_removed(list(collection.find({"_id": {"$in": ids}})))
+    collection.update_many({"_id": {"$in": ids}}, {"$set": {"superseded_by": import_id}})
+
+def _new_import_id():
+    return str(ObjectId())
+
+def _activate(filename, data_type, import_ids, import_errors, content_hash):
+    '''
+    Makes the records written under import_ids the visible records of
+    the file, with a single update to its SourceFile. The file is marked
+    as missing from the rollups and cubes until _mark_applied is called,
+    so that the dashboard reads its raw records in the meantime.
+    '''
+    SourceFile.objects(name=filename).update_one(
+        upsert = True,
+        set__data_type = data_type,
+        set__import_date = datetime.utcnow(),
+        set__import_errors = import_errors,
+        set__content_hash = content_hash,
+        set__rolled_up = False,
+        set__in_cubes = False,
+        set__import_ids = import_ids,
+    )
+    generations.bump("sources")
+
+def _mark_applied(filename, rolled_up=False, in_cubes=False):
+    # called once the deltas of the visible records have been written,
+    # so that a failure before then leaves the rollups or cubes unused
+    SourceFile.objects(name=filename).update_one(
+        set__rolled_up = rolled_up,
+        set__in_cubes = in_cubes,
+    )
+    generations.bump("sources")
+
+def release_record_ids(filename, data_type):
+    # called when a file is deleted, so that its record ids can be
+    # imported from other files
+    document_class = {"case_data": CaseEntry, "serotype": Serotype}[data_type]
+    _release_record_ids(document_class._get_collection(), filename)
+
+def retire(import_ids, data_type):
+    # called once the import ids are no longer listed under any SourceFile
+    for import_id in import_ids:
+        RetiredImport(
+            import_id = import_id,
+            data_type = data_type,
+            retired_at = datetime.utcnow(),
+        ).save()
+
+def collect_garbage(batch_size=None, pause_seconds=None):
+    '''
+    Deletes the records of retired and abandoned import ids, and
+    records superseded by active import ids. These are no longer
+    visible, and are deleted in small batches with pauses in between,
+    to limit the load this puts on the database. Import ids left
+    without records are then dropped from their files.
+    '''
+    batch_size = batch_size or config.GC_BATCH_SIZE
+    if pause_seconds is None:
+        pause_seconds = config.GC_PAUSE_SECONDS
+    document_classes = {"case_data": CaseEntry, "serotype": Serotype}
+
+    for data_type, document_class in document_classes.items():
+        _retire_abandoned(data_type, document_class)
+    _release_abandoned_claims()
+
+    for retired_import in RetiredImport.objects():
+        collection = document_classes[retired_import.data_type]._get_collection()
+        count = _delete_in_batches(
+            collection, {"import_id": retired_import.import_id},
+            batch_size, pause_seconds,
+        )
+        print("Deleted", count, "records of retired import", retired_import.import_id)
+        retired_import.delete()
+
+    active_import_ids = SourceFile.objects().distinct("import_ids")
+    for data_type, document_class in document_classes.items():
+        count = _delete_in_batches(
+            document_class._get_collection(),
+            {"superseded_by": {"$in": active_import_ids}},
+            batch_size, pause_seconds,
+        )
+        print("Deleted", count, "superseded", data_type, "records")
+
+    _drop_empty_import_ids(document_classes)
+
+def _retire_abandoned(data_type, document_class):
+    '''
+    Retires the import ids of records that were written by an import
+    which never activated them, once they are old enough that the
+    import can no longer be running. Import ids are ObjectIds, and
+    carry the time at which the import started.
+    '''
+    cutoff = datetime.utcnow() - timedelta(hours=config.GC_ABANDONED_IMPORT_HOURS)
+    active_import_ids = set(SourceFile.objects().distinct("import_ids"))
+    retired_import_ids = set(RetiredImport.objects().distinct("import_id"))
+    for import_id in document_class._get_collection().distinct("import_id"):
+        if not import_id or import_id in active_import_ids or import_id in retired_import_ids:
+            continue
+        if ObjectId(import_id).generation_time.replace(tzinfo=None)<cutoff:
+            print("Retiring abandoned", data_type, "import", import_id)
+            retire([import_id], data_type)
+
+def _release_abandoned_claims():
+    # record ids claimed by imports of files that were never activated
+    cutoff = datetime.utcnow() - timedelta(hours=config.GC_ABANDONED_IMPORT_HOURS)
+    filenames = SourceFile.objects().distinct("name")
+    result = RecordOwner._get_collection().delete_many({
+        "source_filename": {"$nin": filenames},
+        "claimed_at": {"$lt": cutoff},
+    })
+    if result.deleted_count:
+        print("Released", result.deleted_count, "record ids claimed by abandoned imports")
+
+def _drop_empty_import_ids(document_classes):
+    '''
+    Removes the import ids whose records have all been superseded and
+    deleted from their files, so that the import ids matched by every
+    query stop growing with each update. Import ids still referred to by
+    superseded records are kept, since those would be visible again.
+    '''
+    dropped = 0
+    for source in SourceFile.objects(data_type__in=list(document_classes)):
+        collection = document_classes[source.data_type]._get_collection()
+        # the latest import id is kept even if the file has no records
+        for import_id in source.import_ids[:-1]:
+            in_use = collection.find_one(
+                {"$or": [{"import_id": import_id}, {"superseded_by": import_id}]},
+                {"_id": 1},
+            )
+            if not in_use:
+                SourceFile.objects(name=source.name).update_one(pull__import_ids=import_id)
+                dropped += 1
+    if dropped:
+        print("Dropped", dropped, "import ids without records")
+        generations.bump("sources")
+
+def _delete_in_batches(collection, query, batch_size, pause_seconds):
+    count = 0
+    while True:
+        ids = [d["_id"] for d in collection.find(query, {"_id": 1}).limit(batch_size)]
+        if not ids:
+            return count
+        collection.delete_many({"_id": {"$in": ids}})
+        count += len(ids)
+        time.sleep(pause_seconds)
+
+def _add_region_dates(region_dates, documents):
+    # earliest and latest record dates of the given documents per region
+    for document in documents:
+        date = document["record_date"]
+        for region_id in set(document["regions"]) - {"admin_0", ""}:
+            start_date, end_date = region_dates.get(region_id, (date, date))
+            region_dates[region_id] = (min(start_date, date), max(end_date, date))
+
+def case_data(filename, batch_size=None, content_hash=None):
     '''
     Expected Fields in CSV File:
     
@@ -42,6 +474,10 @@ def case_data(filename):
     - demographics.gender: String representing the gender of patient
     - test.type: Test type used for determining the status of infection
     NOTE: The above 3 fields are only relevant for line lists.
+
+    The entries are written under a new import id, and made visible
+    along with the daily rollups and the feature cube once the whole
+    file is imported.
     '''
     
     source_exists = SourceFile.objects(name=filename).first()
@@ -49,48 +485,95 @@ def case_data(filename):
         print("FILE ALREADY IMPORTED, SKIPPING")
         return
 
-    rows = _read_csv(filename)
-    errors = []
-    line_number = 1
-    for row in rows:
-        line_number += 1
-        try:
-            entry = CaseEntry()
+    import_id = _new_import_id()
+    rollup_deltas = rollups.new_deltas()
+    cube_deltas = cubes.new_deltas()
+    def on_written(documents):
+        for document in documents:
+            rollups.add_entry(rollup_deltas, document)
+            cubes.add_entry(cube_deltas, document)
+
+    errors = _bulk_import(
+        filename, CaseEntry, _case_document, on_written, batch_size,
+        write_batch = _insert_unique_batch,
+        import_id = import_id,
+    )
+    _activate(filename, "case_data", [import_id], errors, content_hash)
+    rollups.apply(rollup_deltas)
+    cubes.apply(cube_deltas)
+    _mark_applied(filename, rolled_up=True, in_cubes=True)
+    generations.bump("data")
+    return errors
 
-            entry.record_id = row["metadata.recordID"]
-            date_str = row["metadata.recordDate"].split("T")[0]
-            entry.record_date = datetime(*list(map(int, date_str.split("-"))))
+def _case_document(row, filename):
+    document = {}
+    document["record_id"] = row["metadata.recordID"]
+    date_str = row["metadata.recordDate"].split("T")[0]
+    document["record_date"] = datetime(*list(map(int, date_str.split("-"))))
 
-            entry.source = row["metadata.source"]
-            assert entry.source
-            entry.source_filename = filename
+    document["source"] = row["metadata.source"]
+    assert document["source"]
+    document["source_filename"] = filename
 
-            entry.hierarchy = row["location.admin.hierarchy"]
-            assert entry.hierarchy
+    document["hierarchy"] = row["location.admin.hierarchy"]
+    assert document["hierarchy"]
 
-            entry.regions = []
-            entry.regions.append(row.get("location.admin1.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin2.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin3.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin4.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin5.ID", "admin_0"))
+    document["regions"] = _regions(row)
 
-            entry.suspected = int((row["cases.suspected"] or "0").split(".")[0])
-            entry.tested = int((row["cases.tested"] or "0").split(".")[0])
-            entry.confirmed = int((row["cases.confirmed"] or "0").split(".")[0])
-            entry.deaths = int((row["cases.deaths"] or "0").split(".")[0])
+    document["suspected"] = int((row["cases.suspected"] or "0").split(".")[0])
+    document["tested"] = int((row["cases.tested"] or "0").split(".")[0])
+    document["confirmed"] = int((row["cases.confirmed"] or "0").split(".")[0])
+    document["deaths"] = int((row["cases.deaths"] or "0").split(".")[0])
 
-            entry.age_range = row["demographics.ageRange"]
-            entry.gender = row["demographics.gender"]
-            entry.test_type = row["test.type"]
+    document["age_range"] = row["demographics.ageRange"]
+    document["gender"] = row["demographics.gender"]
+    document["test_type"] = row["test.type"]
+    for field in ("record_id", "age_range", "gender", "test_type"):
+        assert document[field] is not None, field
 
-            entry.save()
-        except Exception as e:
-            error = traceback.format_exc()
-            errors.append({"line_number": line_number, "error": error, "row": row})
+    document["row_hash"] = _row_hash(row)
+    return document
+
+def update_case_data(filename, batch_size=None, content_hash=None):
+    '''
+    Updates the case entries of a file that was imported earlier and
+    has since changed. The changes are made visible at once, and the
+    daily rollups, the feature cube and the cached dashboard responses
+    are updated only for the regions and dates of the added, changed
+    or removed records.
+    '''
+    source = SourceFile.objects(name=filename).first()
+    import_id = _new_import_id()
+    rollup_deltas = rollups.new_deltas()
+    cube_deltas = cubes.new_deltas()
+    region_dates = {}
+
+    def on_written(documents):
+        for document in documents:
+            rollups.add_entry(rollup_deltas, document)
+            cubes.add_entry(cube_deltas, document)
+        _add_region_dates(region_dates, documents)
+
+    def on_removed(documents):
+        for document in documents:
+            rollups.add_entry(rollup_deltas, document, sign=-1)
+            cubes.add_entry(cube_deltas, document, sign=-1)
+        _add_region_dates(region_dates, documents)
+
+    errors = _update_rows(
+        filename, CaseEntry, _case_document, source.import_ids, import_id,
+        on_written, on_removed, batch_size,
+    )
+    _activate(filename, "case_data", source.import_ids + [import_id], errors, content_hash)
+    if source.rolled_up:
+        rollups.apply(rollup_deltas)
+    if source.in_cubes:
+        cubes.apply(cube_deltas)
+    _mark_applied(filename, rolled_up=source.rolled_up, in_cubes=source.in_cubes)
+    response_cache.invalidate(region_dates)
     return errors
 
-def predictions(filename):
+def predictions(filename, batch_size=None, content_hash=None):
     '''
     Expected fields in CSV file:
 
@@ -110,41 +593,78 @@ def predictions(filename):
         print("FILE ALREADY IMPORTED, SKIPPING")
         return
 
-    rows = _read_csv(filename)
-    errors = []
-    line_number = 1
-    for row in rows:
-        line_number += 1
-        try:
-            obj = Prediction()
-
-            obj.region_id = row["regionID"]
-            assert obj.region_id
-
-            region = Region.objects(region_id=obj.region_id).first()
-            obj.parent_id = region.parent_ids[0] if region.parent_ids else ""
-
-            obj.date = datetime(*map(int, row["startDatePredictedWeek"].split("-")))
-            obj.computation_date = datetime(*map(int, row["dateOfComputingPrediction"].split("-")))
-
-            existing_prediction = Prediction.objects(
-                region_id=obj.region_id, date=obj.date,
-            ).first()
-            if existing_prediction and existing_prediction.computation_date>obj.computation_date:
-                continue
+    parent_ids = {}
+    for region in Region.objects().only("region_id", "parent_ids").as_pymongo():
+        region_parent_ids = region.get("parent_ids") or [""]
+        parent_ids[region["region_id"]] = region_parent_ids[0]
+
+    def to_document(row, filename):
+        document = {}
+        document["region_id"] = row["regionID"]
+        assert document["region_id"]
+        document["parent_id"] = parent_ids[document["region_id"]]
+
+        document["date"] = datetime(*map(int, row["startDatePredictedWeek"].split("-")))
+        document["computation_date"] = datetime(*map(int, row["dateOfComputingPrediction"].split("-")))
+
+        document["source_filename"] = filename
+        document["prediction"] = float(row["prediction"])
+        document["prediction_zone"] = int(str(row["predictionZone"]).split(".")[0])
+        document["threshold_method"] = row.get("thresholdMethod", "")
+        return document
+
+    # predictions are unique per region and week across files, and
+    # are superseded in place instead of under a new import id
+    errors = _bulk_import(
+        filename, Prediction, to_document,
+        batch_size = batch_size,
+        write_batch = _upsert_predictions,
+    )
+    _activate(filename, "predictions", [], errors, content_hash)
+    generations.bump("predictions")
+    generations.bump("data")
+    return errors
 
-            obj.source_filename = filename
-            obj.prediction = float(row["prediction"])
-            obj.prediction_zone = int(str(row["predictionZone"]).split(".")[0])
-            obj.threshold_method = row.get("thresholdMethod", "")
-            obj.save()
-        except Exception as e:
-            error = traceback.format_exc()
+def _upsert_predictions(collection, batch, errors):
+    '''
+    Replaces the existing prediction for each region and week only if
+    it was not computed more recently. The check is part of the update
+    filter, so concurrent imports cannot overwrite newer predictions.
+    '''
+    def conditions(document):
+        return {
+            "region_id": document["region_id"],
+            "date": document["date"],
+            "computation_date": {"$lte": document["computation_date"]},
+        }
+
+    operations = []
+    for _, _, document in batch:
+        operations.append(UpdateOne(conditions(document), {"$set": document}, upsert=True))
+
+    failed = set()
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details["writeErrors"]:
+            line_number, row, document = batch[write_error["index"]]
+            if write_error["code"]==DUPLICATE_KEY_ERROR:
+                # the upsert collided with a prediction for the same region
+                # and week, either a newer one, or an older one inserted by
+                # a concurrent import, which the update without upsert
+                # then replaces
+                try:
+                    collection.update_one(conditions(document), {"$set": document})
+                    continue
+                except PyMongoError as update_error:
+                    error = str(update_error)
+            else:
+                error = write_error["errmsg"]
             errors.append({"line_number": line_number, "error": error, "row": row})
+            failed.add(write_error["index"])
+    return [document for i, (_, _, document) in enumerate(batch) if i not in failed]
 
-    return errors
-
-def serotype(filename):
+def serotype(filename, batch_size=None, content_hash=None):
     '''
     Expected Fields in CSV File:
 
@@ -167,58 +687,145 @@ def serotype(filename):
         print("FILE ALREADY IMPORTED, SKIPPING")
         return
 
-    rows = _read_csv(filename)
-    errors = []
-    line_number = 1
-    for row in rows:
-        line_number += 1
-        try:
-            entry = Serotype()
+    import_id = _new_import_id()
+    cube_deltas = cubes.new_deltas()
+    def on_written(documents):
+        for document in documents:
+            cubes.add_serotype(cube_deltas, document)
+
+    errors = _bulk_import(
+        filename, Serotype, _serotype_document, on_written, batch_size,
+        write_batch = _insert_unique_batch,
+        import_id = import_id,
+    )
+    _activate(filename, "serotype", [import_id], errors, content_hash)
+    cubes.apply(cube_deltas)
+    _mark_applied(filename, in_cubes=True)
+    generations.bump("data")
+    return errors
 
-            entry.record_id = row["metadata.recordID"]
-            date_str = row["event.test.sampleCollectionDate"].split("T")[0]
-            entry.record_date = datetime(*list(map(int, date_str.split("-"))))
+def _serotype_document(row, filename):
+    document = {}
+    document["record_id"] = row["metadata.recordID"]
+    assert document["record_id"] is not None
+    date_str = row["event.test.sampleCollectionDate"].split("T")[0]
+    document["record_date"] = datetime(*list(map(int, date_str.split("-"))))
 
-            entry.source_filename = filename
+    document["source_filename"] = filename
 
-            entry.hierarchy = row["location.admin.hierarchy"]
-            assert entry.hierarchy
+    document["hierarchy"] = row["location.admin.hierarchy"]
+    assert document["hierarchy"]
 
-            entry.regions = []
-            entry.regions.append(row.get("location.admin1.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin2.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin3.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin4.ID", "admin_0"))
-            entry.regions.append(row.get("location.admin5.ID", "admin_0"))
+    document["regions"] = _regions(row)
 
-            entry.serotype = row.get("event.test.test3.serotype", "UNKNOWN").upper()
-            entry.save()
-        except Exception as e:
-            error = traceback.format_exc()
-            errors.append({"line_number": line_number, "error": error, "row": row})
+    document["serotype"] = row.get("event.test.test3.serotype", "UNKNOWN").upper()
+
+    document["row_hash"] = _row_hash(row)
+    return document
+
+def update_serotype(filename, batch_size=None, content_hash=None):
+    '''
+    Updates the serotype records of a file that was imported earlier
+    and has since changed. See update_case_data.
+    '''
+    source = SourceFile.objects(name=filename).first()
+    import_id = _new_import_id()
+    cube_deltas = cubes.new_deltas()
+    region_dates = {}
+
+    def on_written(documents):
+        for document in documents:
+            cubes.add_serotype(cube_deltas, document)
+        _add_region_dates(region_dates, documents)
+
+    def on_removed(documents):
+        for document in documents:
+            cubes.add_serotype(cube_deltas, document, sign=-1)
+        _add_region_dates(region_dates, documents)
+
+    errors = _update_rows(
+        filename, Serotype, _serotype_document, source.import_ids, import_id,
+        on_written, on_removed, batch_size,
+    )
+    _activate(filename, "serotype", source.import_ids + [import_id], errors, content_hash)
+    if source.in_cubes:
+        cubes.apply(cube_deltas)
+    _mark_applied(filename, in_cubes=source.in_cubes)
+    response_cache.invalidate(region_dates)
     return errors
 
-def regions(filename):
-    rows = _read_csv(filename)
+def _ancestor_ids(region_id, row_index, chains):
+    '''
+    Returns the ids of the region's parent, its parent and so on. The
+    chain of every region passed through is stored in chains, so that
+    each is walked only once however many regions share it.
+    '''
+    path, seen = [], set()
+    current = region_id
+    while current in row_index and current not in chains and current not in seen:
+        seen.add(current)
+        path.append(current)
+        current = row_index[current]["parentID"]
+
+    if current in chains:
+        chain = (current,) + chains[current]
+    else:
+        # the root was reached, or a region already on the path
+        if current in seen:
+            print("CYCLE IN PARENT IDS AT", current)
+        chain = ()
+    for ancestor_id in reversed(path):
+        chains[ancestor_id] = chain
+        chain = (ancestor_id,) + chain
+    return chains[region_id]
+
+def regions(filename, batch_size=None):
+    '''
+    Upserts the regions of the file by region id, so that the file can
+    be imported again, and returns the ids of previously imported
+    regions which are missing from it. These are reported but not
+    deleted.
+    '''
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    start_time = time.time()
     row_index = {}
-    for row in rows:
+    for _, row in _read_csv(filename):
         row_index[row["regionID"]] = row
 
-    for region_id in row_index:
-        row = row_index[region_id]
-
-        region = Region()
-        region.region_id = region_id
-        region.region_type = region_id.split("_")[0]
-        region.name = row["regionName"]
-        region.parent_ids = []
-        region.parent_names = []
-
-        parent_row = row_index.get(row["parentID"])
-        while parent_row:
-            region.parent_ids.append(parent_row["regionID"])
-            region.parent_names.append(parent_row["regionName"])
-
-            parent_row = row_index.get(parent_row["parentID"])
-
-        region.save()
+    chains = {}
+    operations = []
+    for region_id, row in row_index.items():
+        parent_ids = _ancestor_ids(region_id, row_index, chains)
+        operations.append(UpdateOne(
+            {"region_id": region_id},
+            {"$set": dict(
+                region_type = region_id.split("_")[0],
+                name = row["regionName"],
+                parent_ids = list(parent_ids),
+                parent_names = [row_index[parent_id]["regionName"] for parent_id in parent_ids],
+            )},
+            upsert = True,
+        ))
+
+    # upserts rely on the unique index to never duplicate a region
+    Region.ensure_indexes()
+    collection = Region._get_collection()
+    for i in range(0, len(operations), batch_size):
+        collection.bulk_write(operations[i:i+batch_size], ordered=False)
+
+    missing_ids = sorted(
+        region["region_id"]
+        for region in Region.objects().only("region_id").as_pymongo()
+        if region["region_id"] not in row_index
+    )
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f'Imported {len(operations)} regions in {elapsed:.1f}s')
+    if missing_ids:
+        print(len(missing_ids), "EXISTING REGION(S) MISSING FROM THE FILE:")
+        for region_id in missing_ids:
+            print(region_id)
+
+    # running servers reload their region index, and drop cached responses
+    generations.bump("regions")
+    generations.bump("data")
+    return missing_ids
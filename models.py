@@ -8,7 +8,7 @@ from mongoengine import *
 connect(host=config.DB_URI)
 
 class CaseEntry(Document):
-    record_id = StringField(unique=True, required=True)
+    record_id = StringField(required=True)
     record_date = DateTimeField(required=True)
 
     source = StringField(required=True)
@@ -26,16 +26,89 @@ class CaseEntry(Document):
     gender = StringField(required=True)
     test_type = StringField(required=True)
 
+    # hash of the source file row, used to detect changed records
+    row_hash = StringField()
+
+    # see SourceFile.import_ids
+    import_id = StringField()
+    superseded_by = StringField()
+
     meta = {
         "collection": "cases",
         "indexes": [
+            {"fields": ["record_id", "import_id"], "unique": True},
             ("regions", "record_date"),
-            "source_filename"
+            "source_filename",
+            "import_id",
+            "superseded_by",
+        ]
+    }
+
+class DailyCount(Document):
+    region_id = StringField(required=True)
+    date = DateTimeField(required=True)
+    source = StringField(required=True)
+
+    suspected = IntField(default=0)
+    tested = IntField(default=0)
+    confirmed = IntField(default=0)
+    deaths = IntField(default=0)
+
+    meta = {
+        "collection": "daily_counts",
+        "indexes": [
+            {"fields": ["region_id", "date", "source"], "unique": True},
+        ]
+    }
+
+# earliest and latest dates with case counts under each region,
+# recomputed from the daily rollups after each sync
+class RegionRecordDates(Document):
+    region_id = StringField(unique=True, required=True)
+    first_date = DateTimeField(required=True)
+    last_date = DateTimeField(required=True)
+
+    meta = {
+        "collection": "region_record_dates",
+    }
+
+# confirmed line list cases and serotype records per region and
+# week (starting Monday), see cubes.py
+class FeatureCount(Document):
+    region_id = StringField(required=True)
+    week = DateTimeField(required=True)
+    age_range = StringField(required=True)
+    gender = StringField(required=True)
+    test_type = StringField(required=True)
+
+    confirmed = IntField(default=0)
+
+    meta = {
+        "collection": "feature_counts",
+        "indexes": [
+            {
+                "fields": ["region_id", "week", "age_range", "gender", "test_type"],
+                "unique": True,
+            },
+        ]
+    }
+
+class SerotypeCount(Document):
+    region_id = StringField(required=True)
+    week = DateTimeField(required=True)
+    serotype = StringField(required=True)
+
+    count = IntField(default=0)
+
+    meta = {
+        "collection": "serotype_counts",
+        "indexes": [
+            {"fields": ["region_id", "week", "serotype"], "unique": True},
         ]
     }
 
 class Serotype(Document):
-    record_id = StringField(unique=True, required=True)
+    record_id = StringField(required=True)
     record_date = DateTimeField(required=True)
 
     source_filename = StringField(required=True)
@@ -45,11 +118,21 @@ class Serotype(Document):
 
     serotype = StringField(required=True)
 
+    # hash of the source file row, used to detect changed records
+    row_hash = StringField()
+
+    # see SourceFile.import_ids
+    import_id = StringField()
+    superseded_by = StringField()
+
     meta = {
         "collection": "serotype",
         "indexes": [
+            {"fields": ["record_id", "import_id"], "unique": True},
             ("regions", "record_date"),
-            "source_filename"
+            "source_filename",
+            "import_id",
+            "superseded_by",
         ]
     }
 
@@ -82,7 +165,7 @@ class Region(Document):
 
     meta = {
         "collection": "regions",
-        "indexes": ["parent_ids.0"]
+        "indexes": ["parent_ids.0", "parent_ids"]
     }
 
     def in_scope(self, region_id):
@@ -93,9 +176,44 @@ class SourceFile(Document):
     data_type = StringField(required=True)
     import_date = DateTimeField(required=True, default=datetime.utcnow())
     import_errors = ListField(default=[])
+    content_hash = StringField()
+    rolled_up = BooleanField(default=False)
+    in_cubes = BooleanField(default=False)
+
+    # Case and serotype records are written under a new import id each
+    # time a file is imported, and become visible to the dashboard only
+    # once the id is added to this list. Records marked as superseded_by
+    # a listed import id are hidden.
+    import_ids = ListField(StringField(), default=[])
 
     meta = {"collection": "source_files"}
 
+class RetiredImport(Document):
+    # records of import ids no longer listed under any SourceFile,
+    # which are deleted by the garbage collector
+    import_id = StringField(required=True)
+    data_type = StringField(required=True)
+    retired_at = DateTimeField(required=True)
+
+    meta = {"collection": "retired_imports"}
+
+class RecordOwner(Document):
+    # the file each case or serotype record id was claimed by, whose
+    # unique index keeps a record id from being imported from two
+    # files, even by imports running concurrently
+    record_collection = StringField(required=True)
+    record_id = StringField(required=True)
+    source_filename = StringField(required=True)
+    claimed_at = DateTimeField(required=True)
+
+    meta = {
+        "collection": "record_owners",
+        "indexes": [
+            {"fields": ["record_collection", "record_id"], "unique": True},
+            "source_filename",
+        ]
+    }
+
 class User(Document):
     user_id = StringField(required=True)
     tenant_id = StringField(required=True)
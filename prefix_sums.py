@@ -0,0 +1,168 @@
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+import generations
+from models import DailyCount
+import rollups
+
+INDEX_DIR = "cache/prefix_sums/"
+os.makedirs(INDEX_DIR, exist_ok=True)
+
+READ_CHUNK_SIZE = 100000
+
+class PrefixSums:
+    '''
+    Cumulative per region daily stage counts, where sums[i, d] holds
+    the totals of region i over the first d days of the index. The
+    totals over any date range are then the difference of two rows.
+    '''
+
+    def __init__(self, path):
+        with open(path + "meta.json") as f:
+            meta = json.load(f)
+        self.rollups_generation = meta["rollups_generation"]
+        self.start_date = datetime.datetime.fromisoformat(meta["start_date"])
+        self.stages = meta["stages"]
+        self.positions = {r: i for i, r in enumerate(meta["region_ids"])}
+
+        # memory mapped, so that the pages are shared by all workers
+        self.sums = np.load(path + "sums.npy", mmap_mode="r")
+
+    def range_sums(self, region_ids, start_date, end_date):
+        '''
+        Returns an array of the stage totals of each of the given
+        regions between the two dates, both inclusive.
+        '''
+        n_days = self.sums.shape[1] - 1
+        start = min(max((start_date - self.start_date).days, 0), n_days)
+        end = min(max((end_date - self.start_date).days + 1, 0), n_days)
+
+        positions = np.array([self.positions.get(r, -1) for r in region_ids], dtype=np.intp)
+        found = positions>=0
+
+        totals = np.zeros((len(region_ids), len(self.stages)), dtype=np.int64)
+        if end>start:
+            rows = positions[found]
+            totals[found] = self.sums[rows, end] - self.sums[rows, start]
+        return totals
+
+    def stage_totals(self, region_ids, start_date, end_date, stages):
+        totals = self.range_sums(region_ids, start_date, end_date)
+        columns = [self.stages.index(stage) for stage in stages]
+        return [
+            dict(zip(stages, row))
+            for row in totals[:, columns].tolist()
+        ]
+
+def build():
+    '''
+    Builds the index from the daily rollups, and publishes it for the
+    server workers. The index records the rollups generation marker it
+    was built at, and is not used once the rollups change again.
+    '''
+    rollups_generation = generations.get("rollups")
+
+    region_ids = sorted(DailyCount.objects().distinct("region_id"))
+    first = DailyCount.objects().order_by("date").only("date").first()
+    last = DailyCount.objects().order_by("-date").only("date").first()
+    if not region_ids or not first:
+        return None
+
+    start_date = first.date
+    n_days = (last.date - start_date).days + 1
+    positions = {r: i for i, r in enumerate(region_ids)}
+    stages = list(rollups.STAGES)
+
+    # daily counts are placed one day ahead, so that the cumulative
+    # sums start from a row of zeros
+    sums = np.zeros((len(region_ids), n_days + 1, len(stages)), dtype=np.int64)
+
+    query = DailyCount.objects().only("region_id", "date", *stages).as_pymongo()
+    rows, days, values = [], [], []
+    for doc in query:
+        rows.append(positions[doc["region_id"]])
+        days.append((doc["date"] - start_date).days + 1)
+        values.append([doc.get(stage) or 0 for stage in stages])
+        if len(rows)>=READ_CHUNK_SIZE:
+            np.add.at(sums, (rows, days), values)
+            rows, days, values = [], [], []
+    if rows:
+        np.add.at(sums, (rows, days), values)
+
+    np.cumsum(sums, axis=1, out=sums)
+    if sums.max(initial=0)<np.iinfo(np.int32).max:
+        sums = sums.astype(np.int32)
+
+    version = str(time.time_ns())
+    path = INDEX_DIR + version + "/"
+    os.makedirs(path)
+    np.save(path + "sums.npy", sums)
+    with open(path + "meta.json", "w") as f:
+        json.dump({
+            "rollups_generation": rollups_generation,
+            "start_date": start_date.isoformat(),
+            "stages": stages,
+            "region_ids": region_ids,
+        }, f)
+
+    _publish(version)
+    return sums.shape
+
+def _publish(version):
+    tmp_filepath = f'{INDEX_DIR}current.{os.getpid()}.tmp'
+    with open(tmp_filepath, "w") as f:
+        f.write(version)
+    os.replace(tmp_filepath, INDEX_DIR + "current")
+
+    # workers still mapping an older index keep reading it after deletion
+    for name in os.listdir(INDEX_DIR):
+        if name!=version and os.path.isdir(INDEX_DIR + name):
+            shutil.rmtree(INDEX_DIR + name, ignore_errors=True)
+
+def _current_version():
+    try:
+        with open(INDEX_DIR + "current") as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+def is_current():
+    '''
+    Whether the published index was built from the current rollups.
+    '''
+    try:
+        with open(INDEX_DIR + _current_version() + "/meta.json") as f:
+            return json.load(f)["rollups_generation"]==generations.get("rollups")
+    except FileNotFoundError:
+        return False
+
+_lock = threading.Lock()
+_index = None
+_loaded_version = None
+
+def current():
+    '''
+    Returns the index if it was built from the current rollups, or
+    None if it has not been built yet or the data has changed since.
+    '''
+    global _index, _loaded_version
+    version = _current_version()
+    with _lock:
+        if _loaded_version!=version:
+            try:
+                _index = PrefixSums(INDEX_DIR + version + "/") if version else None
+            except FileNotFoundError:
+                # replaced by a newer build while being loaded
+                return None
+            _loaded_version = version
+        index = _index
+
+    if index and index.rollups_generation==generations.get("rollups"):
+        return index
+    return None
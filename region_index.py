@@ -0,0 +1,93 @@
+import threading
+
+import generations
+from models import Region, RegionRecordDates
+
+class RegionNode:
+    __slots__ = (
+        "region_id", "region_type", "name",
+        "parent_ids", "parent_names",
+        "ancestor_ids", "children", "depth", "breadcrumbs",
+        "first_record_date", "last_record_date",
+    )
+
+    def __init__(self, doc):
+        self.region_id = doc["region_id"]
+        self.region_type = doc["region_type"]
+        self.name = doc["name"]
+        self.parent_ids = doc.get("parent_ids", [])
+        self.parent_names = doc.get("parent_names", [])
+        self.ancestor_ids = frozenset(self.parent_ids)
+        self.children = []
+        self.depth = len(self.parent_ids)
+
+        # [name, region_id] pairs from the topmost region down to this one
+        self.breadcrumbs = [
+            [name, region_id]
+            for name, region_id in zip(self.parent_names, self.parent_ids)
+        ][::-1] + [[self.name, self.region_id]]
+
+        # None for regions without any case counts
+        self.first_record_date = None
+        self.last_record_date = None
+
+    def in_scope(self, region_id):
+        return self.region_id==region_id or region_id in self.ancestor_ids
+
+    def breadcrumbs_under(self, scope_region):
+        # breadcrumbs above the tenant's scope region are not shown
+        for i, (_, region_id) in enumerate(self.breadcrumbs):
+            if region_id==scope_region:
+                return self.breadcrumbs[i:]
+        return self.breadcrumbs
+
+_lock = threading.RLock()
+_nodes = {}
+_loaded_generation = None
+
+def load():
+    '''
+    Loads all regions into memory, replacing the existing index.
+    Called at worker startup, and again whenever the regions are
+    reimported, or their record dates recomputed, by another process.
+    '''
+    global _nodes, _loaded_generation
+    with _lock:
+        generation = _generation()
+        docs = Region.objects().only(
+            "region_id", "region_type", "name", "parent_ids", "parent_names",
+        ).as_pymongo()
+
+        nodes = {}
+        for doc in docs:
+            nodes[doc["region_id"]] = RegionNode(doc)
+        for node in nodes.values():
+            if node.parent_ids and node.parent_ids[0] in nodes:
+                nodes[node.parent_ids[0]].children.append(node)
+
+        for doc in RegionRecordDates.objects().as_pymongo():
+            node = nodes.get(doc["region_id"])
+            if node:
+                node.first_record_date = doc["first_date"]
+                node.last_record_date = doc["last_date"]
+
+        _nodes = nodes
+        _loaded_generation = generation
+
+def _generation():
+    return (generations.get("regions"), generations.get("record_dates"))
+
+def all_nodes():
+    '''
+    Returns the current region_id -> RegionNode dict, for looking up
+    many regions at once.
+    '''
+    generation = _generation()
+    if _loaded_generation!=generation:
+        with _lock:
+            if _loaded_generation!=generation:
+                load()
+    return _nodes
+
+def get(region_id):
+    return all_nodes().get(region_id)
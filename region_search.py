@@ -1,56 +1,262 @@
+from bisect import bisect_left
+import hashlib
+import heapq
 import os
 import json
+import pickle
+import resource
+import threading
+import time
 
+from cachetools import LRUCache
 from fast_autocomplete import AutoComplete, autocomplete_factory
+from fast_autocomplete.lfucache import LFUCache
+from mongoengine import Q
 
+import generations
 from models import Region
+import region_index
 from tenants import all_tenants
 
+SEARCH_SIZE = 5
+
+# no. of search results cached per tenant
+RESULT_CACHE_SIZE = 5000
+
 os.makedirs("autocomplete_objs/", exist_ok=True)
 
+# regions generation and words hash each tenant's file was built from
+MANIFEST_FILE = "autocomplete_objs/manifest.json"
+
+def _load_manifest():
+    try:
+        with open(MANIFEST_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# ranking of the regions of each type in fuzzy search results
+REGION_TYPE_COUNTS = {
+    "country": 10,
+    "state": 9,
+    "district": 8,
+    "ulb": 8,
+    "subdistrict": 7,
+    "zone": 7,
+    "prabhag": 7,
+    "ward": 4,
+    "village": 4,
+}
+
+def words(regions):
+    '''
+    Returns the autocomplete words of the given regions, each a dict
+    with region_id, region_type and name.
+    '''
+    tenant_words = {}
+    for region in regions:
+        key = region["name"] + " " + region["region_id"]
+        context = {}
+        display = region["region_id"] + "|||" + region["name"]
+        count = REGION_TYPE_COUNTS[region["region_type"]]
+        tenant_words[key] = [context, display, count]
+    return tenant_words
+
+def write_words(tenant_id, tenant_words, previous_hash=None):
+    '''
+    Writes the tenant's words along with their autocompleter snapshot,
+    unless they match the previous hash and the snapshot exists.
+    Returns the hash of the words and whether they were written.
+    '''
+    content = json.dumps(tenant_words, sort_keys=True)
+    words_hash = hashlib.sha256(content.encode()).hexdigest()
+    if previous_hash==words_hash and os.path.exists(snapshot_filepath(tenant_id)):
+        return words_hash, False
+
+    with open(_words_filepath(tenant_id), "w") as f:
+        f.write(content)
+    _write_snapshot(tenant_id)
+    return words_hash, True
+
 def generate_objs():
-    counts = {
-        "country": 10,
-        "state": 9,
-        "district": 8,
-        "ulb": 8,
-        "subdistrict": 7,
-        "zone": 7,
-        "prabhag": 7,
-        "ward": 4,
-        "village": 4,
-    }
+    '''
+    Writes the autocomplete words of each tenant's scope region and the
+    regions under it. Tenants are skipped if the regions have not been
+    reimported since their file was written, and files are rewritten
+    only if their words have changed.
+    '''
+    manifest = _load_manifest()
+    regions_generation = generations.get("regions")
     for tenant in all_tenants:
-        words = {}
-        regions_to_visit = list(Region.objects(region_id=tenant.scope_region))
-        while regions_to_visit:
-            region = regions_to_visit[0]
-            print(tenant.tenant_id, region.region_id)
-            key = region.name + " " + region.region_id
-            context = {}
-            display = region.region_id + "|||" + region.name
-            count = counts[region.region_type]
-            words[key] = [context, display, count]
-            regions_to_visit = regions_to_visit[1:] + list(Region.objects(parent_ids__0=region.region_id))
-        with open("autocomplete_objs/" + tenant.tenant_id + ".json", "w") as f:
-            json.dump(words, f)
-
-autocompleters = {}
+        built = manifest.get(tenant.tenant_id, {})
+        if all([
+            built.get("regions_generation")==regions_generation,
+            built.get("scope_region")==tenant.scope_region,
+            os.path.exists(_words_filepath(tenant.tenant_id)),
+        ]):
+            print(tenant.tenant_id, "regions unchanged, skipping")
+            continue
+
+        # the scope region and its whole subtree, in a single query
+        regions = Region.objects(
+            Q(region_id=tenant.scope_region) | Q(parent_ids=tenant.scope_region)
+        ).only("region_id", "region_type", "name").as_pymongo()
+
+        tenant_words = words(regions)
+        words_hash, written = write_words(tenant.tenant_id, tenant_words, built.get("hash"))
+        print(tenant.tenant_id, len(tenant_words), "regions,", "written" if written else "unchanged")
+
+        manifest[tenant.tenant_id] = dict(
+            regions_generation = regions_generation,
+            scope_region = tenant.scope_region,
+            hash = words_hash,
+        )
+
+    with open(MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f)
+
+def _words_filepath(tenant_id):
+    return "autocomplete_objs/" + tenant_id + ".json"
+
+def snapshot_filepath(tenant_id):
+    return "autocomplete_objs/" + tenant_id + ".pickle"
+
+def _build(tenant_id):
+    return autocomplete_factory(
+        content_files = {
+            "words": {
+                "filepath": _words_filepath(tenant_id),
+                "compress": True
+            }
+        }
+    )
+
+def _write_snapshot(tenant_id):
+    # locks cannot be pickled, and are recreated on loading
+    state = dict(vars(_build(tenant_id)))
+    del state["_lock"], state["_lfu_cache"]
+
+    filepath = snapshot_filepath(tenant_id)
+    with open(filepath + ".tmp", "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filepath + ".tmp", filepath)
+
+def _load(tenant_id):
+    '''
+    Loads the tenant's autocompleter from its snapshot, written by
+    generate_objs, which is much faster than building it from words.
+    Falls back to building it if the snapshot is missing or outdated.
+    '''
+    start_time = time.time()
+    start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    filepath = snapshot_filepath(tenant_id)
+    words_filepath = _words_filepath(tenant_id)
+    if os.path.exists(filepath) and os.path.getmtime(filepath)>=os.path.getmtime(words_filepath):
+        with open(filepath, "rb") as f:
+            state = pickle.load(f)
+        autocompleter = AutoComplete.__new__(AutoComplete)
+        vars(autocompleter).update(state)
+        autocompleter._lock = threading.Lock()
+        autocompleter._lfu_cache = LFUCache(AutoComplete.CACHE_SIZE)
+    else:
+        autocompleter = _build(tenant_id)
+
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory
+    print(
+        f'Loaded autocomplete for {tenant_id} in {time.time() - start_time:.2f}s,',
+        f'{memory / 1024:.1f} MB (pid {os.getpid()})',
+    )
+    return autocompleter
+
+def _normalize(term):
+    return " ".join(term.lower().split())
+
+class TenantIndex:
+    '''
+    A tenant's autocompleter, along with its words sorted for exact
+    prefix lookups, and a cache of recent search results.
+    '''
+
+    def __init__(self, autocompleter):
+        self.autocompleter = autocompleter
+
+        words = []
+        for key, word in autocompleter.words.items():
+            region_id, name = word.display.split("|||")
+            words.append((_normalize(key), region_id, name, word.count))
+        words.sort()
+        self.keys = [word[0] for word in words]
+        self.regions = [word[1:] for word in words]
+
+        self.lock = threading.Lock()
+        self.results = LRUCache(maxsize=RESULT_CACHE_SIZE)
+
+    def prefix_matches(self, term):
+        # (region_id, name, count) of all the words starting with the term
+        end_term = term[:-1] + chr(ord(term[-1]) + 1)
+        return self.regions[bisect_left(self.keys, term):bisect_left(self.keys, end_term)]
+
+_lock = threading.Lock()
+indexes = {}
+
+def get(tenant_id):
+    # autocompleters are loaded on the first search of each tenant
+    index = indexes.get(tenant_id)
+    if index is None:
+        with _lock:
+            if tenant_id not in indexes:
+                indexes[tenant_id] = TenantIndex(_load(tenant_id))
+            index = indexes[tenant_id]
+    return index
+
 def init():
+    '''
+    Loads the autocompleters of all tenants at once. Used by gunicorn
+    before forking the workers, which then share them copy-on-write.
+    '''
     for tenant in all_tenants:
-        autocompleters[tenant.tenant_id] = autocomplete_factory(
-            content_files = {
-                "words": {
-                    "filepath":"autocomplete_objs/" + tenant.tenant_id + ".json",
-                    "compress": True
-                }
-            }
+        get(tenant.tenant_id)
+
+def search(tenant_id, term, home_region=None):
+    '''
+    Returns [region_id, name] of the regions matching the search term.
+    Regions under the user's home region are ranked first, followed by
+    larger regions. Fuzzy matching is used only if too few region
+    names start with the term.
+    '''
+    index = get(tenant_id)
+    term = _normalize(term)
+    if not term:
+        return []
+
+    cache_key = (term, home_region)
+    with index.lock:
+        results = index.results.get(cache_key)
+    if results is not None:
+        return results
+
+    nodes = region_index.all_nodes()
+    def under_home_region(region_id):
+        node = nodes.get(region_id)
+        return bool(home_region and node and node.in_scope(home_region))
+
+    matches = index.prefix_matches(term)
+    if len(matches)>=SEARCH_SIZE:
+        # short terms match many regions, of which only the best are sorted
+        matches = heapq.nsmallest(
+            SEARCH_SIZE, matches,
+            key = lambda m: (not under_home_region(m[0]), -m[2], m[1]),
         )
+    else:
+        matches = []
+        for match in index.autocompleter.search(word=term, max_cost=3, size=SEARCH_SIZE):
+            word = index.autocompleter.words[match[0]]
+            matches.append(word.display.split("|||"))
+        # stable, so that closer matches stay ahead otherwise
+        matches.sort(key=lambda m: not under_home_region(m[0]))
 
-def search(tenant_id, term):
-    matches = autocompleters[tenant_id].search(word=term, max_cost=3, size=5)
-    results = []
-    for match in matches:
-        word = autocompleters[tenant_id].words[match[0]]
-        results.append(word.display.split("|||"))
+    results = [[region_id, name] for region_id, name, *_ in matches[:SEARCH_SIZE]]
+    with index.lock:
+        index.results[cache_key] = results
     return results
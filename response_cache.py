@@ -0,0 +1,243 @@
+from collections import defaultdict
+from datetime import timedelta
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import config
+import generations
+
+CACHE_DB = "cache/responses.sqlite3"
+os.makedirs(os.path.dirname(CACHE_DB), exist_ok=True)
+
+# permissions which change the contents of a query response
+RELEVANT_PERMISSIONS = ("predictions", "report_download")
+
+SCHEMA_VERSION = 2
+
+# last use times and hit counts of cached responses are written at most
+# this often by each thread
+FLUSH_INTERVAL_SECONDS = 10
+
+# trends are computed over whole weeks or months around the requested dates
+DATE_MARGIN = timedelta(days=31)
+
+_local = threading.local()
+
+def _connection():
+    # sqlite connections cannot be shared across threads or forked workers
+    if getattr(_local, "pid", None)!=os.getpid():
+        conn = sqlite3.connect(CACHE_DB, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("PRAGMA user_version").fetchone()[0]!=SCHEMA_VERSION:
+            # cached responses are disposable, so older layouts are dropped
+            conn.execute("DROP TABLE IF EXISTS responses")
+            conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            generation TEXT NOT NULL,
+            region_id TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL,
+            value BLOB NOT NULL
+        )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_region_id ON responses (region_id)")
+        conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("COMMIT")
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.last_used = {}
+        _local.counts = defaultdict(int)
+        _local.flushed_at = time.time()
+    return _local.conn
+
+def _count(conn, name, amount=1):
+    conn.execute(
+        "INSERT INTO stats VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + ?",
+        (name, amount, amount),
+    )
+
+def make_key(tenant, user, region_id, start_date, end_date, aggregates, granularity):
+    permissions = sorted(set(user.permissions) & set(RELEVANT_PERMISSIONS))
+    key = json.dumps([
+        tenant.tenant_id,
+        region_id,
+        start_date,
+        end_date,
+        sorted(aggregates),
+        granularity,
+        permissions,
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def get(key):
+    '''
+    Returns the cached response, or None if it is missing or outdated,
+    or if the cache is locked for too long by the other workers.
+    Outdated responses are replaced by put, or evicted.
+    '''
+    try:
+        conn = _connection()
+        row = conn.execute(
+            "SELECT generation, value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+    result = None
+    if row and row[0]==generations.get("data"):
+        _local.last_used[key] = time.time()
+        _local.counts["hits"] += 1
+        result = json.loads(zlib.decompress(row[1]))
+    else:
+        _local.counts["misses"] += 1
+
+    if time.time() - _local.flushed_at>=FLUSH_INTERVAL_SECONDS:
+        _flush(conn)
+    return result
+
+def _flush(conn):
+    '''
+    Writes the last use times and hit counts of the cached responses,
+    which are kept in memory in between, since every write takes the
+    lock shared by all workers. They are kept for the next time if the
+    cache is locked.
+    '''
+    _local.flushed_at = time.time()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "UPDATE responses SET last_used = ? WHERE key = ?",
+            [(last_used, key) for key, last_used in _local.last_used.items()],
+        )
+        for name, amount in _local.counts.items():
+            _count(conn, name, amount)
+        conn.execute("COMMIT")
+    except sqlite3.OperationalError:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        return
+    _local.last_used.clear()
+    _local.counts.clear()
+
+def _invalidations(conn):
+    row = conn.execute("SELECT value FROM stats WHERE name = 'invalidations'").fetchone()
+    return row[0] if row else 0
+
+def version():
+    '''
+    Returns the data generation and the no. of invalidations so far, to
+    be read before computing a response and passed along with it to put.
+    '''
+    try:
+        return generations.get("data"), _invalidations(_connection())
+    except sqlite3.OperationalError:
+        return generations.get("data"), None
+
+def put(key, response, region_id, start_date, end_date, version):
+    '''
+    Caches a response computed from the data at the given version. The
+    response is dropped if the data has changed since, as it may have
+    been computed partly from the older data.
+    '''
+    generation, invalidations = version
+    if generations.get("data")!=generation or invalidations is None:
+        return
+    value = zlib.compress(json.dumps(response).encode())
+
+    # checked in the same transaction as the write, since an invalidation
+    # in between would leave the older response cached
+    try:
+        conn = _connection()
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        # the response is left uncached if the cache is locked for too long
+        return
+    try:
+        if _invalidations(conn)!=invalidations:
+            conn.execute("ROLLBACK")
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key, generation,
+                region_id, start_date, end_date,
+                len(value), time.time(), value,
+            ),
+        )
+        _evict(conn)
+        conn.execute("COMMIT")
+    except sqlite3.OperationalError:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _evict(conn):
+    # evict least recently used responses until the cache fits
+    max_size = config.RESPONSE_CACHE_MAX_MB * 1024 * 1024
+    total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total_size>max_size:
+        rows = conn.execute("SELECT key, size FROM responses ORDER BY last_used")
+        evicted_keys = []
+        for evicted_key, size in rows:
+            if total_size<=max_size:
+                break
+            evicted_keys.append((evicted_key,))
+            total_size -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+
+def invalidate(region_dates):
+    '''
+    Drops the cached responses affected by a change in data, given as
+    a dict of region_id -> (earliest date, latest date) of the changed
+    records. Responses of other regions or dates are left cached.
+    '''
+    conn = _connection()
+    params = []
+    for region_id, (start_date, end_date) in region_dates.items():
+        params.append((
+            region_id,
+            (end_date + DATE_MARGIN).date().isoformat(),
+            (start_date - DATE_MARGIN).date().isoformat(),
+        ))
+    # counted, so that responses computed before the change and cached
+    # after it are dropped by put
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "DELETE FROM responses WHERE region_id = ? AND start_date <= ? AND end_date >= ?",
+            params,
+        )
+        _count(conn, "invalidations")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def stats():
+    # counts kept in memory by the other workers are not included yet
+    conn = _connection()
+    _flush(conn)
+    result = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+    entries, size = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+    ).fetchone()
+    return {
+        "hits": result.get("hits", 0),
+        "misses": result.get("misses", 0),
+        "invalidations": result.get("invalidations", 0),
+        "entries": entries,
+        "size_bytes": size,
+        "max_size_bytes": config.RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+    }
@@ -0,0 +1,89 @@
+from collections import defaultdict
+
+import counts
+import generations
+from models import CaseEntry, DailyCount, RegionRecordDates, SourceFile
+import visibility
+
+STAGES = ("suspected", "tested", "confirmed", "deaths")
+KEY_FIELDS = ("region_id", "date", "source")
+
+def new_deltas():
+    '''
+    Returns an accumulator of per (region_id, date, source)
+    stage counts, to be filled using add_entry and written
+    using apply.
+    '''
+    return defaultdict(lambda: dict.fromkeys(STAGES, 0))
+
+def add_entry(deltas, entry, sign=1):
+    for region_id in counts.region_ids(entry):
+        stage_counts = deltas[(region_id, entry["record_date"], entry["source"])]
+        for stage in STAGES:
+            stage_counts[stage] += sign * (entry[stage] or 0)
+
+def apply(deltas):
+    if counts.write(DailyCount, KEY_FIELDS, deltas):
+        generations.bump("rollups")
+
+def _unwind_regions_pipeline():
+    # a case entry is counted once for each distinct region it falls under
+    return counts.unwind_regions_pipeline(
+        ("record_date", "source") + STAGES,
+        {"date": "$record_date", "source": "$source"},
+        {stage: {"$sum": f'${stage}'} for stage in STAGES},
+    )
+
+def add_source(deltas, source, sign=1):
+    '''
+    Adds the visible case entries of the given source file to the
+    deltas, used with sign=-1 to remove a file from the rollups when
+    its records are hidden or replaced.
+    '''
+    query = counts.source_records(CaseEntry, source)
+    for row in query.aggregate(_unwind_regions_pipeline()):
+        stage_counts = deltas[tuple(row["_id"][field] for field in KEY_FIELDS)]
+        for stage in STAGES:
+            stage_counts[stage] += sign * row[stage]
+
+def is_complete():
+    '''
+    The rollups can be used in place of raw case entries only if
+    every imported case data file has been added to them.
+    '''
+    return counts.all_sources(["case_data"], "rolled_up")
+
+def rebuild():
+    '''
+    Recomputes all rollups from raw case entries on the database
+    server. Used when setting up rollups on an existing database.
+    '''
+    query = CaseEntry.objects(__raw__=visibility.visible())
+    counts.rebuild(DailyCount, query, _unwind_regions_pipeline(), KEY_FIELDS, STAGES)
+    SourceFile.objects(data_type="case_data").update(rolled_up=True)
+    generations.bump("sources")
+    generations.bump("rollups")
+
+def update_record_dates():
+    '''
+    Replaces the earliest and latest record dates of each region with
+    those of its non-zero rollups, and lets the server workers know.
+    '''
+    DailyCount.objects().aggregate([
+        {"$match": {"$or": [{stage: {"$ne": 0}} for stage in STAGES]}},
+        {"$group": {
+            "_id": "$region_id",
+            "first_date": {"$min": "$date"},
+            "last_date": {"$max": "$date"},
+        }},
+        {"$project": {
+            "_id": 0,
+            "region_id": "$_id",
+            "first_date": 1,
+            "last_date": 1,
+        }},
+        # replaces the collection at once
+        {"$out": RegionRecordDates._get_collection_name()},
+    ], allowDiskUse=True)
+    RegionRecordDates.ensure_indexes()
+    generations.bump("record_dates")
@@ -0,0 +1,230 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import json
+import os
+
+from models import Region
+import region_search
+from server_admin import compress_maps, generate_subregion_maps
+import subregion_maps
+from tenants import all_tenants
+
+# input keys of the artifacts as they were last built
+STATE_FILE = "cache/artifacts.json"
+
+def _load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _write_state(state):
+    tmp_filepath = STATE_FILE + ".tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_filepath, STATE_FILE)
+
+def _key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+def _map_keys(filepaths, neighbours, content_hashes, vertex_budgets, byte_budgets):
+    '''
+    A compressed map depends on the junctions and tolerances of its
+    neighbours, and their junctions on their own neighbours, so its key
+    covers every map within two borders of it.
+    '''
+    keys = {}
+    for filepath in filepaths:
+        nearby = {filepath} | neighbours[filepath]
+        for neighbour in list(nearby):
+            nearby |= neighbours[neighbour]
+
+        inputs = []
+        for f in sorted(nearby):
+            region_type = compress_maps.region_type(f)
+            inputs.append((
+                f,
+                content_hashes[f],
+                vertex_budgets.get(region_type, compress_maps.DEFAULT_VERTEX_BUDGET),
+                byte_budgets.get(region_type),
+            ))
+        keys[filepath] = _key(compress_maps.PRECISION, inputs)
+    return keys
+
+def _collection_keys(regions, map_keys, topojson, quantization):
+    # subregion ids of each region, along with the keys of their maps
+    compressed_keys = {
+        compress_maps.target_filepath(filepath): key
+        for filepath, key in map_keys.items()
+    }
+    children = defaultdict(list)
+    for region in regions:
+        if region.get("parent_ids"):
+            children[region["parent_ids"][0]].append(region["region_id"])
+
+    keys, subregion_ids = {}, {}
+    for region in regions:
+        region_id = region["region_id"]
+        if region["region_type"] in ["village", "ward"] or not children[region_id]:
+            continue
+        subregion_ids[region_id] = sorted(children[region_id])
+        keys[region_id] = _key(topojson, quantization, [
+            (subregion_id, compressed_keys.get(
+                f'{generate_subregion_maps.MAP_FOLDER}compressed_individual/{subregion_id}.geojson'
+            ))
+            for subregion_id in subregion_ids[region_id]
+        ])
+    return keys, subregion_ids
+
+def _autocomplete_keys(regions):
+    keys, tenant_regions = {}, {}
+    for tenant in all_tenants:
+        scope = tenant.scope_region
+        tenant_regions[tenant.tenant_id] = [
+            region for region in regions
+            if region["region_id"]==scope or scope in region.get("parent_ids", [])
+        ]
+        keys[tenant.tenant_id] = _key(scope, sorted(
+            (region["region_id"], region["name"], region["region_type"])
+            for region in tenant_regions[tenant.tenant_id]
+        ))
+    return keys, tenant_regions
+
+def _build_autocomplete(tenant_id, regions):
+    tenant_words = region_search.words(regions)
+    region_search.write_words(tenant_id, tenant_words)
+    return len(tenant_words)
+
+def _print_stale(title, stale, removed):
+    print(f'\n{title}: {len(stale)} stale, {len(removed)} removed')
+    for name in stale:
+        print("  stale:", name)
+    for name in removed:
+        print("  removed:", name)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--list-stale", action="store_true",
+        help="list the artifacts whose inputs have changed, without building them",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(),
+        help="no. of artifacts built concurrently, each in its own process",
+    )
+    compress_maps.add_budget_arguments(parser)
+    generate_subregion_maps.add_format_arguments(parser)
+    args = parser.parse_args()
+    vertex_budgets = dict(compress_maps.VERTEX_BUDGETS, **compress_maps.parse_budgets(args.vertices))
+    byte_budgets = compress_maps.parse_budgets(args.bytes)
+
+    state = _load_state()
+    built_maps = state.setdefault("maps", {})
+    built_collections = state.setdefault("collections", {})
+    built_autocomplete = state.setdefault("autocomplete", {})
+
+    # every input is read, since a change to any of them is only known
+    # from its content
+    filepaths = sorted(glob.glob(compress_maps.SOURCE_DIR + "**/*.geojson", recursive=True))
+    junctions, neighbours, content_hashes = compress_maps.load_topology(filepaths)
+    map_keys = _map_keys(filepaths, neighbours, content_hashes, vertex_budgets, byte_budgets)
+    stale_maps = [
+        filepath for filepath in filepaths
+        if built_maps.get(filepath)!=map_keys[filepath]
+        or not os.path.exists(compress_maps.target_filepath(filepath))
+    ]
+    targets = set(map(compress_maps.target_filepath, filepaths))
+    removed_maps = sorted(
+        filepath
+        for filepath in glob.glob(compress_maps.TARGET_DIR + "**/*.geojson", recursive=True)
+        if filepath not in targets
+    )
+
+    regions = list(Region.objects().only(
+        "region_id", "region_type", "name", "parent_ids",
+    ).as_pymongo())
+    collection_keys, subregion_ids = _collection_keys(
+        regions, map_keys, args.topojson, args.quantization,
+    )
+    manifest = generate_subregion_maps.load_manifest()
+    stale_collections = [
+        region_id for region_id, key in collection_keys.items()
+        if built_collections.get(region_id)!=key
+        or (region_id in manifest and not os.path.exists(
+            subregion_maps.MAP_DIR + manifest[region_id]["filename"]
+        ))
+    ]
+    removed_collections = sorted(
+        (set(manifest) | set(built_collections)) - set(collection_keys)
+    )
+
+    autocomplete_keys, tenant_regions = _autocomplete_keys(regions)
+    stale_autocomplete = [
+        tenant_id for tenant_id, key in autocomplete_keys.items()
+        if built_autocomplete.get(tenant_id)!=key
+        or not os.path.exists(region_search.snapshot_filepath(tenant_id))
+    ]
+    removed_autocomplete = sorted(set(built_autocomplete) - set(autocomplete_keys))
+
+    _print_stale("COMPRESSED MAPS", stale_maps, removed_maps)
+    _print_stale("SUBREGION MAPS", stale_collections, removed_collections)
+    _print_stale("AUTOCOMPLETE OBJECTS", stale_autocomplete, removed_autocomplete)
+    if args.list_stale:
+        return
+
+    print("\nGENERATING COMPRESSED MAPS...")
+    for filepath in removed_maps:
+        os.remove(filepath)
+    if stale_maps:
+        compress_maps.compress(
+            stale_maps, junctions, neighbours, vertex_budgets, byte_budgets, args.workers,
+        )
+    state["maps"] = {filepath: map_keys[filepath] for filepath in filepaths}
+    _write_state(state)
+
+    executor = ProcessPoolExecutor(max_workers=args.workers)
+    with executor:
+        print("\nGENERATING SUBREGION MAPS...")
+        futures = {}
+        for region_id in stale_collections:
+            futures[region_id] = executor.submit(
+                generate_subregion_maps.build_collection,
+                region_id, subregion_ids[region_id], args.topojson, args.quantization,
+            )
+        for region_id, future in futures.items():
+            entry = future.result()
+            previous = manifest.pop(region_id, None)
+            if previous and (not entry or previous["filename"]!=entry["filename"]):
+                generate_subregion_maps.remove_collection(previous["filename"])
+            if entry:
+                manifest[region_id] = entry
+            built_collections[region_id] = collection_keys[region_id]
+        for region_id in removed_collections:
+            previous = manifest.pop(region_id, None)
+            if previous:
+                generate_subregion_maps.remove_collection(previous["filename"])
+            built_collections.pop(region_id, None)
+        generate_subregion_maps.write_manifest(manifest)
+        _write_state(state)
+
+        print("\nGENERATING AUTOCOMPLETE OBJECTS...")
+        futures = {}
+        for tenant_id in stale_autocomplete:
+            futures[tenant_id] = executor.submit(
+                _build_autocomplete, tenant_id, tenant_regions[tenant_id],
+            )
+        for tenant_id, future in futures.items():
+            print(tenant_id, future.result(), "regions, written")
+            built_autocomplete[tenant_id] = autocomplete_keys[tenant_id]
+        for tenant_id in removed_autocomplete:
+            del built_autocomplete[tenant_id]
+        _write_state(state)
+
+    print("\nDone")
+
+if __name__=="__main__":
+    main()
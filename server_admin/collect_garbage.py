@@ -0,0 +1,5 @@
+import import_from_file
+
+print("DELETING RECORDS HIDDEN BY IMPORTS AND DELETIONS...")
+import_from_file.collect_garbage()
+print("Done")
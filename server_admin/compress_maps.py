@@ -0,0 +1,301 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from server_admin import topology
+
+SOURCE_DIR = "source_files/geojsons/individual/"
+TARGET_DIR = "source_files/geojsons/compressed_individual/"
+
+# target no. of vertices in the compressed map of a region, by region type
+VERTEX_BUDGETS = dict(
+    country = 20000,
+    state = 10000,
+    district = 4000,
+    subdistrict = 2000,
+    ulb = 2000,
+    zone = 1000,
+    village = 400,
+    ward = 400,
+)
+DEFAULT_VERTEX_BUDGET = 2000
+
+# decimal places kept in the coordinates, about 10cm in degrees
+PRECISION = 6
+
+# points shared by more than two borders, set in each worker process
+_junctions = set()
+
+def _init_worker(junctions):
+    global _junctions
+    _junctions = junctions
+
+def _rings(data):
+    # open rings of every polygon in the file, with points as tuples
+    for feature in data["features"]:
+        for polygon in topology.polygons(feature["geometry"]):
+            for ring in polygon:
+                points = topology.open_ring([tuple(p[:2]) for p in ring])
+                if len(points)>=3:
+                    yield points
+
+def _canonical(arc):
+    # shared arcs are simplified in the same direction in every file
+    reversed_arc = arc[::-1]
+    if reversed_arc<arc:
+        return reversed_arc, True
+    return arc, False
+
+def _arc_id(arc):
+    return hashlib.blake2b(np.array(arc).tobytes(), digest_size=8).hexdigest()
+
+def _importance(points):
+    '''
+    Douglas-Peucker importance of each vertex of an arc, i.e. the
+    largest tolerance at which it is kept. End points are always kept,
+    as are the interior vertices needed to keep a ring from collapsing:
+    one for arcs between two junctions, two for closed arcs.
+    '''
+    n = len(points)
+    importance = np.zeros(n)
+    importance[0] = importance[-1] = np.inf
+
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        first, last, limit = stack.pop()
+        if last - first<2:
+            continue
+        a, b = points[first], points[last]
+        segment = points[first+1:last]
+        dx, dy = b - a
+        length = np.hypot(dx, dy)
+        if length==0:
+            distances = np.hypot(segment[:, 0] - a[0], segment[:, 1] - a[1])
+        else:
+            distances = np.abs(dx * (segment[:, 1] - a[1]) - dy * (segment[:, 0] - a[0])) / length
+
+        i = first + 1 + int(np.argmax(distances))
+        # a vertex is never kept at a tolerance its parent is dropped at
+        importance[i] = min(distances[i - first - 1], limit)
+        stack.append((first, i, importance[i]))
+        stack.append((i, last, importance[i]))
+
+    forced = 2 if n>3 and (points[0]==points[-1]).all() else 1
+    if n>2:
+        interior = np.argsort(importance[1:-1])[-forced:] + 1
+        importance[interior] = np.inf
+    return importance
+
+def _file_arcs(data):
+    arcs = {}
+    for ring in _rings(data):
+        for arc in topology.split_ring(ring, _junctions):
+            canonical, _ = _canonical(arc)
+            arcs.setdefault(_arc_id(canonical), canonical)
+    return arcs
+
+def _threshold(filepath, vertex_budget, byte_budget):
+    '''
+    Returns the arc ids of a file, along with the smallest tolerance
+    that brings the file within its budget.
+    '''
+    start_time = time.time()
+    with open(filepath) as f:
+        data = json.load(f)
+
+    importances = {}
+    vertex_count = 0
+    for arc_id, arc in _file_arcs(data).items():
+        importances[arc_id] = _importance(np.array(arc))
+        vertex_count += len(arc) - 1
+
+    if byte_budget:
+        vertex_budget = byte_budget * vertex_count // max(os.path.getsize(filepath), 1)
+
+    interior = np.concatenate([i[1:-1] for i in importances.values()] or [np.zeros(0)])
+    optional = np.sort(interior[np.isfinite(interior)])
+    budget = vertex_budget - len(importances) - (len(interior) - len(optional))
+    if budget>=len(optional):
+        threshold = 0
+    elif budget<=0:
+        threshold = np.inf
+    else:
+        threshold = float(optional[-budget])
+    return list(importances), threshold, time.time() - start_time
+
+def _compress(filepath, target_filepath, thresholds):
+    start_time = time.time()
+    with open(filepath) as f:
+        data = json.load(f)
+
+    original_count, simplified_count = 0, 0
+    for feature in data["features"]:
+        geometry = feature["geometry"]
+        polygons = []
+        for polygon in topology.polygons(geometry):
+            rings = []
+            for ring in polygon:
+                points = topology.open_ring([tuple(p[:2]) for p in ring])
+                if len(points)<3:
+                    continue
+                simplified = []
+                for arc in topology.split_ring(points, _junctions):
+                    canonical, reversed_arc = _canonical(arc)
+                    arc_points = np.array(canonical)
+                    importance = _importance(arc_points)
+                    arc_points = arc_points[importance>=thresholds[_arc_id(canonical)]]
+                    if reversed_arc:
+                        arc_points = arc_points[::-1]
+                    # consecutive arcs share their end points
+                    simplified.extend(arc_points.round(PRECISION).tolist()[1 if simplified else 0:])
+                rings.append(simplified)
+                original_count += len(points) + 1
+                simplified_count += len(simplified)
+            if rings and len(rings[0])>=4:
+                polygons.append(rings)
+
+        if geometry and geometry["type"]=="Polygon":
+            geometry["coordinates"] = polygons[0] if polygons else []
+        elif geometry and geometry["type"]=="MultiPolygon":
+            geometry["coordinates"] = polygons
+
+    content = json.dumps(data, separators=(",", ":"))
+    os.makedirs(os.path.dirname(target_filepath), exist_ok=True)
+    with open(target_filepath, "w") as f:
+        f.write(content)
+    return original_count, simplified_count, len(content), time.time() - start_time
+
+def target_filepath(filepath):
+    return TARGET_DIR + os.path.relpath(filepath, SOURCE_DIR)
+
+def region_type(filepath):
+    return os.path.basename(filepath).split("_")[0]
+
+def load_topology(filepaths):
+    '''
+    Reads all the given individual maps, and returns the junctions of
+    their rings, the files that each file shares border points with,
+    and the content hash of each file.
+    '''
+    rings = []
+    point_files = {}
+    neighbours = defaultdict(set)
+    content_hashes = {}
+    for filepath in filepaths:
+        with open(filepath, "rb") as f:
+            content = f.read()
+        content_hashes[filepath] = hashlib.sha256(content).hexdigest()
+        for ring in _rings(json.loads(content)):
+            rings.append(ring)
+            for point in ring:
+                other = point_files.setdefault(point, filepath)
+                if other!=filepath:
+                    neighbours[filepath].add(other)
+                    neighbours[other].add(filepath)
+    return topology.find_junctions(rings), neighbours, content_hashes
+
+def compress(filepaths, junctions, neighbours, vertex_budgets, byte_budgets, workers):
+    '''
+    Simplifies the given individual maps, given the junctions and
+    neighbours of all maps from load_topology. The tolerances of their
+    neighbours are computed as well, since the borders shared with them
+    are kept at the finer detail of the two.
+    '''
+    start_time = time.time()
+    measured_filepaths = set(filepaths)
+    for filepath in filepaths:
+        measured_filepaths |= neighbours[filepath]
+
+    executor = ProcessPoolExecutor(
+        max_workers = workers,
+        initializer = _init_worker,
+        initargs = (junctions,),
+    )
+    with executor:
+        file_arc_ids, arc_thresholds, elapsed = {}, {}, {}
+        futures = {}
+        for filepath in sorted(measured_filepaths):
+            futures[filepath] = executor.submit(
+                _threshold, filepath,
+                vertex_budgets.get(region_type(filepath), DEFAULT_VERTEX_BUDGET),
+                byte_budgets.get(region_type(filepath)),
+            )
+        for filepath, future in futures.items():
+            arc_ids, threshold, elapsed[filepath] = future.result()
+            file_arc_ids[filepath] = arc_ids
+            for arc_id in arc_ids:
+                # shared arcs are kept at the finer detail of the two regions
+                arc_thresholds[arc_id] = min(arc_thresholds.get(arc_id, np.inf), threshold)
+
+        futures = {}
+        for filepath in filepaths:
+            thresholds = {arc_id: arc_thresholds[arc_id] for arc_id in file_arc_ids[filepath]}
+            futures[filepath] = executor.submit(
+                _compress, filepath, target_filepath(filepath), thresholds,
+            )
+
+        total_size, total_compressed_size = 0, 0
+        for filepath, future in futures.items():
+            original_count, simplified_count, compressed_size, compress_time = future.result()
+            size = os.path.getsize(filepath)
+            total_size += size
+            total_compressed_size += compressed_size
+            print(
+                filepath,
+                f'{original_count} -> {simplified_count} vertices,',
+                f'{size} -> {compressed_size} bytes',
+                f'({size / max(compressed_size, 1):.1f}x)',
+                f'in {elapsed[filepath] + compress_time:.2f}s',
+            )
+
+    print(
+        f'\nCompressed {total_size} -> {total_compressed_size} bytes',
+        f'({total_size / max(total_compressed_size, 1):.1f}x)',
+        f'in {time.time() - start_time:.1f}s',
+    )
+
+def parse_budgets(values):
+    # "region_type=number" pairs
+    return {k: int(v) for k, v in (value.split("=") for value in values)}
+
+def add_budget_arguments(parser):
+    parser.add_argument(
+        "--vertices", nargs="*", default=[], metavar="REGION_TYPE=N",
+        help="target no. of vertices per map of the given region types",
+    )
+    parser.add_argument(
+        "--bytes", nargs="*", default=[], metavar="REGION_TYPE=N",
+        help="target file size per map of the given region types, used instead of --vertices",
+    )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(),
+        help="no. of files simplified concurrently, each in its own process",
+    )
+    add_budget_arguments(parser)
+    args = parser.parse_args()
+    vertex_budgets = dict(VERTEX_BUDGETS, **parse_budgets(args.vertices))
+    byte_budgets = parse_budgets(args.bytes)
+
+    print("\nGENERATING COMPRESSED MAPS...")
+    filepaths = sorted(glob.glob(SOURCE_DIR + "**/*.geojson", recursive=True))
+    for filepath in glob.glob(TARGET_DIR + "**/*.geojson", recursive=True):
+        os.remove(filepath)
+
+    # borders shared between regions are split into arcs at the same
+    # points in every file, so that neighbouring maps stay aligned
+    junctions, neighbours, _ = load_topology(filepaths)
+    print(len(filepaths), "files,", len(junctions), "junctions")
+    compress(filepaths, junctions, neighbours, vertex_budgets, byte_budgets, args.workers)
+
+if __name__=="__main__":
+    main()
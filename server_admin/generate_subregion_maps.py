@@ -1,31 +1,123 @@
+import argparse
+import gzip
+import hashlib
 import json
 import os
 
 from models import Region
+from server_admin import topology
+import subregion_maps
+
+# brotli variants are written only if the optional package is installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 MAP_FOLDER = "source_files/geojsons/"
 os.makedirs(MAP_FOLDER+"subregions/", exist_ok=True)
 
-for region in Region.objects():
-    if region.region_type in ["village", "ward"]:
-        continue
-
-    subregions = Region.objects(parent_ids__0=region.region_id)
-    if not subregions:
-        continue
+def write_variants(filepath, content):
+    # pre-compressed once here, instead of on every request
+    with open(filepath, "wb") as f:
+        f.write(content)
+    with open(filepath + ".gz", "wb") as f:
+        f.write(gzip.compress(content, compresslevel=9))
+    if brotli:
+        with open(filepath + ".br", "wb") as f:
+            f.write(brotli.compress(content, quality=11))
 
-    print("\nProcessing", region.region_id)
+def build_collection(region_id, subregion_ids, topojson=False, quantization=100000):
+    '''
+    Writes the map of the given subregions of a region from their
+    compressed maps, and returns its manifest entry, or None if none of
+    the subregions has a map.
+    '''
     features = []
-    for subregion in subregions:
+    for subregion_id in subregion_ids:
         try:
-            with open(f'{MAP_FOLDER}compressed_individual/{subregion.region_id}.geojson') as f:
+            with open(f'{MAP_FOLDER}compressed_individual/{subregion_id}.geojson') as f:
                 data = json.loads(f.read())
             feature = data["features"][0]
-            feature["properties"] = {"region_id": subregion.region_id}
+            feature["properties"] = {"region_id": subregion_id}
             features.append(feature)
         except FileNotFoundError:
-            print("DATA NOT AVAILABLE", subregion.region_id)
-    if features:
+            print("DATA NOT AVAILABLE", subregion_id)
+    if not features:
+        return None
+
+    if topojson:
+        filename = region_id + ".topojson"
+        topo = topology.to_topojson(features, "subregions", quantization)
+        content = json.dumps(topo, separators=(",", ":")).encode()
+    else:
+        filename = region_id + ".geojson"
         fc = {"type": "FeatureCollection", "features": features}
-        with open(f'{MAP_FOLDER}subregions/{region.region_id}.geojson', "w") as f:
-            f.write(json.dumps(fc))
+        content = json.dumps(fc).encode()
+    write_variants(MAP_FOLDER + "subregions/" + filename, content)
+    print(region_id, "size:", len(content), "bytes")
+    return {
+        "version": hashlib.sha256(content).hexdigest()[:16],
+        "filename": filename,
+    }
+
+def remove_collection(filename):
+    for extension in ["", ".gz", ".br"]:
+        try:
+            os.remove(MAP_FOLDER + "subregions/" + filename + extension)
+        except FileNotFoundError:
+            pass
+
+def load_manifest():
+    try:
+        with open(subregion_maps.MANIFEST_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_manifest(manifest):
+    # the manifest is replaced at once, after all maps are written
+    tmp_filepath = subregion_maps.MANIFEST_FILE + ".tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_filepath, subregion_maps.MANIFEST_FILE)
+
+def add_format_arguments(parser):
+    parser.add_argument(
+        "--topojson", action="store_true",
+        help="write TopoJSON maps, with shared borders stored once and quantized coordinates",
+    )
+    parser.add_argument(
+        "--quantization", type=int, default=100000,
+        help="no. of distinct TopoJSON coordinate values along each axis",
+    )
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_format_arguments(parser)
+    args = parser.parse_args()
+
+    manifest = {}
+    for region in Region.objects():
+        if region.region_type in ["village", "ward"]:
+            continue
+
+        subregions = Region.objects(parent_ids__0=region.region_id).only("region_id")
+        if not subregions:
+            continue
+
+        print("\nProcessing", region.region_id)
+        entry = build_collection(
+            region.region_id,
+            [subregion.region_id for subregion in subregions],
+            args.topojson,
+            args.quantization,
+        )
+        if entry:
+            manifest[region.region_id] = entry
+
+    write_manifest(manifest)
+    print("\nWrote", len(manifest), "maps")
+
+if __name__=="__main__":
+    main()
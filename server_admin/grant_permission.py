@@ -1,5 +1,6 @@
 import sys
 
+import generations
 from models import User
 
 user_id = sys.argv[1]
@@ -11,4 +12,5 @@ if permission not in user.permissions:
     user.permissions.append(permission)
     user.permissions.sort()
 user.save()
+generations.bump("users")
 print("Granted, new permission list is:", user.permissions)
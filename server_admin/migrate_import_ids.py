@@ -0,0 +1,57 @@
+from bson import ObjectId
+from mongoengine import Q
+from pymongo.errors import OperationFailure
+
+import generations
+from models import CaseEntry, RecordOwner, Serotype, SourceFile
+
+# records imported before import ids were introduced are assigned
+# one import id per source file, which is then made visible
+document_classes = {"case_data": CaseEntry, "serotype": Serotype}
+for data_type, document_class in document_classes.items():
+    collection = document_class._get_collection()
+    try:
+        # record ids are now unique per import in the index, and checked
+        # against the visible records of other files while importing
+        collection.drop_index("record_id_1")
+    except OperationFailure:
+        pass
+    document_class.ensure_indexes()
+
+    legacy_sources = SourceFile.objects(
+        Q(import_ids__exists=False) | Q(import_ids__size=0),
+        data_type = data_type,
+    )
+    for source in legacy_sources:
+        import_id = str(ObjectId())
+        result = collection.update_many(
+            {"source_filename": source.name, "import_id": None},
+            {"$set": {"import_id": import_id}},
+        )
+        source.update(import_ids=[import_id])
+        print(source.name, result.modified_count, "records")
+
+# record ids of existing records are claimed by their files, so that
+# they cannot be imported again from other files
+RecordOwner.ensure_indexes()
+for data_type, document_class in document_classes.items():
+    collection = document_class._get_collection()
+    collection.aggregate([
+        {"$group": {"_id": "$record_id", "source_filename": {"$first": "$source_filename"}}},
+        {"$project": {
+            "_id": 0,
+            "record_collection": {"$literal": collection.name},
+            "record_id": "$_id",
+            "source_filename": 1,
+            "claimed_at": "$$NOW",
+        }},
+        {"$merge": {
+            "into": RecordOwner._get_collection_name(),
+            "on": ["record_collection", "record_id"],
+            "whenMatched": "keepExisting",
+            "whenNotMatched": "insert",
+        }},
+    ], allowDiskUse=True)
+    print(data_type, "record ids claimed")
+
+generations.bump("sources")
@@ -0,0 +1,13 @@
+import cubes
+import prefix_sums
+import rollups
+
+print("REBUILDING DAILY ROLLUPS FROM CASE ENTRIES...")
+rollups.rebuild()
+print("BUILDING PREFIX SUM INDEX...")
+print("Shape:", prefix_sums.build())
+print("UPDATING REGION RECORD DATES...")
+rollups.update_record_dates()
+print("REBUILDING FEATURE AND SEROTYPE CUBES...")
+cubes.rebuild()
+print("Done")
@@ -1,5 +1,6 @@
 import sys
 
+import generations
 from models import User
 
 user_id = sys.argv[1]
@@ -11,4 +12,5 @@ if permission in user.permissions:
     user.permissions.remove(permission)
     user.permissions.sort()
 user.save()
+generations.bump("users")
 print("removed, new permissions list is:", user.permissions)
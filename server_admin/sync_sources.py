@@ -1,49 +1,185 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import datetime
 import glob
+import hashlib
+import itertools
+import multiprocessing
 import os
+import subprocess
+import sys
+import traceback
 
+import cubes
+import generations
 import import_from_file
-from models import CaseEntry, Prediction, SourceFile
+from models import CaseEntry, Prediction, Serotype, SourceFile
+import prefix_sums
+import rollups
 
 DATA_TYPES = ("case_data", "predictions", "serotype")
 SOURCE_DIR = "source_files/"
 
+# data types whose records have a unique record id, so that changed
+# files can be reimported row by row
+INCREMENTAL_DATA_TYPES = ("case_data", "serotype")
+
 def _delete_source(source):
+    '''
+    Deleting the SourceFile hides all of its records at once. The
+    records themselves are deleted later by the garbage collector.
+    '''
     print("\nDeleting", source.name)
+    rollup_deltas = rollups.new_deltas()
+    if source.data_type=="case_data" and source.rolled_up:
+        rollups.add_source(rollup_deltas, source, sign=-1)
+    cube_deltas = cubes.new_deltas()
+    if source.in_cubes:
+        cubes.add_source(cube_deltas, source, sign=-1)
+    source.delete()
+    rollups.apply(rollup_deltas)
+    cubes.apply(cube_deltas)
+
     if source.data_type=="case_data":
-        CaseEntry.objects(source_filename=source.name).delete()
+        CaseEntry.objects(source_filename=source.name, import_id=None).delete()
+    elif source.data_type=="serotype":
+        Serotype.objects(source_filename=source.name, import_id=None).delete()
     elif source.data_type=="predictions":
         Prediction.objects(source_filename=source.name).delete()
-    source.delete()
+        generations.bump("predictions")
+    if source.data_type in INCREMENTAL_DATA_TYPES:
+        import_from_file.release_record_ids(source.name, source.data_type)
+    import_from_file.retire(source.import_ids, source.data_type)
+
+    generations.bump("sources")
+    generations.bump("data")
+
+def _file_hash(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _import_file(data_type, filepath, content_hash, update):
+    # runs in worker processes, each of which connects to the
+    # database on its own when importing models
+    print("\nIMPORTING:", filepath)
+    if update:
+        import_fn = getattr(import_from_file, "update_" + data_type)
+    else:
+        import_fn = getattr(import_from_file, data_type)
+    return import_fn(filepath, content_hash=content_hash)
+
+def _report_import(filepath, import_errors):
+    # the importers record their results under SourceFile themselves
+    if import_errors is not None:
+        print("\nIMPORTED:", filepath)
+        print(len(import_errors), "ERROR(S)")
+
+def _report_failure(filepath):
+    # a failed file is left to the next sync, without stopping this one
+    print("\nIMPORT FAILED:", filepath)
+    traceback.print_exc()
+
+def _changed_files():
+    '''
+    Returns (data_type, filepath, content_hash, update) for each file
+    to be imported, where update is True for previously imported files
+    whose records can be updated row by row.
+    '''
+    files = []
+    for t in DATA_TYPES:
+        dir = SOURCE_DIR + t + "/"
+        filepaths = itertools.chain(
+            glob.iglob(dir + "**/*.csv", recursive=True),
+            glob.iglob(dir + "**/*.csv.gz", recursive=True),
+        )
+        for filepath in filepaths:
+            print("\nPROCESSING:", filepath)
+            source = SourceFile.objects(name=filepath).first()
+            content_hash = None
+            if source:
+                print("Source Exists, Last Synced At:", source.import_date)
+                last_mod_date = datetime.datetime.utcfromtimestamp(os.path.getmtime(filepath))
+                print("File Last Modified At:", last_mod_date)
+                if source.import_date>last_mod_date:
+                    print("File Unchanged, Skipping Import")
+                    continue
+
+                content_hash = _file_hash(filepath)
+                if source.content_hash==content_hash:
+                    print("File Contents Unchanged, Skipping Import")
+                    source.update(import_date=datetime.datetime.utcnow())
+                    continue
+                elif t in INCREMENTAL_DATA_TYPES and source.import_ids:
+                    print("File Changed, Updating Changed Records")
+                    files.append((t, filepath, content_hash, True))
+                    continue
+                else:
+                    print("File Changed, Dropping and Reimporting Records")
+                    _delete_source(source)
+            files.append((t, filepath, content_hash or _file_hash(filepath), False))
+    return files
+
+def _import_in_parallel(files, workers):
+    # spawned workers do not inherit the parent's database connection
+    executor = ProcessPoolExecutor(
+        max_workers = workers,
+        mp_context = multiprocessing.get_context("spawn"),
+    )
+    with executor:
+        futures = {}
+        for t, filepath, content_hash, update in files:
+            future = executor.submit(_import_file, t, filepath, content_hash, update)
+            futures[future] = filepath
+
+        for future in as_completed(futures):
+            filepath = futures[future]
+            try:
+                _report_import(filepath, future.result())
+            except Exception:
+                _report_failure(filepath)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="no. of files to import concurrently, each in its own process",
+    )
+    args = parser.parse_args()
+
+    print("\n\nCHECKING IF ANY EXISTING SOURCES HAVE BEEN DELETED")
+    for source in SourceFile.objects():
+        if not os.path.exists(source.name):
+            print(source.name, "not present in source_files/")
+            _delete_source(source)
+
+    rollups_generation = generations.get("rollups")
+    files = _changed_files()
+
+    if args.workers<=1:
+        for t, filepath, content_hash, update in files:
+            try:
+                _report_import(filepath, _import_file(t, filepath, content_hash, update))
+            except Exception:
+                _report_failure(filepath)
+    else:
+        _import_in_parallel(files, args.workers)
+
+    if rollups.is_complete():
+        if not prefix_sums.is_current():
+            print("\nBUILDING PREFIX SUM INDEX")
+            print("Shape:", prefix_sums.build())
+        if generations.get("rollups")!=rollups_generation:
+            print("\nUPDATING REGION RECORD DATES")
+            rollups.update_record_dates()
 
+    # records hidden by this sync are deleted in the background
+    subprocess.Popen(
+        [sys.executable, "-m", "server_admin.collect_garbage"],
+        start_new_session = True,
+    )
 
-print("\n\nCHECKING IF ANY EXISTING SOURCES HAVE BEEN DELETED")
-for source in SourceFile.objects():
-    if not os.path.exists(source.name):
-        print(source.name, "not present in source_files/")
-        _delete_source(source)
-
-for t in DATA_TYPES:
-    dir = SOURCE_DIR + t + "/"
-    for filepath in glob.iglob(dir + "**/*.csv", recursive=True):
-        print("\nPROCESSING:", filepath)
-        source = SourceFile.objects(name=filepath).first()
-        if source:
-            print("Source Exists, Last Synced At:", source.import_date)
-            last_mod_date = datetime.datetime.utcfromtimestamp(os.path.getmtime(filepath))
-            print("File Last Modified At:", last_mod_date)
-            if source.import_date>last_mod_date:
-                print("File Unchanged, Skipping Import")
-                continue
-            else:
-                print("File Changed, Dropping and Reimporting Records")
-                _delete_source(source)
-
-        import_errors = getattr(import_from_file, t)(filepath)
-        if import_errors is not None:
-            print(len(import_errors), "ERROR(S)")
-            SourceFile(
-                name = filepath,
-                data_type = t,
-                import_errors = import_errors,
-            ).save()
+if __name__=="__main__":
+    main()
@@ -0,0 +1,148 @@
+from collections import defaultdict
+
+def polygons(geometry):
+    # list of polygons, each a list of rings, of a GeoJSON geometry
+    if not geometry:
+        return []
+    if geometry["type"]=="Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"]=="MultiPolygon":
+        return geometry["coordinates"]
+    return []
+
+def open_ring(ring):
+    # drops the closing point, and points repeated one after another
+    points = []
+    for point in ring:
+        if not points or points[-1]!=point:
+            points.append(point)
+    if len(points)>1 and points[0]==points[-1]:
+        points.pop()
+    return points
+
+def find_junctions(rings):
+    '''
+    Returns the points at which the given open rings stop sharing a
+    border. A border shared by two rings is traversed in opposite
+    directions, so its points have the same pair of neighbours in
+    both; a point with more than one pair of neighbours is where the
+    border meets a third ring or ends.
+    '''
+    neighbours = defaultdict(set)
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            neighbours[point].add(frozenset((ring[i-1], ring[(i+1)%n])))
+    return {point for point, pairs in neighbours.items() if len(pairs)>1}
+
+def split_ring(ring, junctions):
+    '''
+    Splits an open ring into arcs at the given junctions. Each arc
+    starts and ends at a junction, and consecutive arcs share their
+    end points. A ring without junctions is returned as a single
+    closed arc, starting at its smallest point so that rings shared
+    in full are split the same way.
+    '''
+    starts = [i for i, point in enumerate(ring) if point in junctions]
+    if not starts:
+        i = ring.index(min(ring))
+        points = ring[i:] + ring[:i]
+        return [points + [points[0]]]
+
+    points = ring[starts[0]:] + ring[:starts[0]]
+    offsets = [i - starts[0] for i in starts] + [len(ring)]
+    points.append(points[0])
+    return [points[a:b+1] for a, b in zip(offsets, offsets[1:])]
+
+class ArcIndex:
+    '''
+    Deduplicates arcs, referring to an arc traversed in reverse by the
+    one's complement of its index, as in TopoJSON.
+    '''
+
+    def __init__(self):
+        self.arcs = []
+        self._indexes = {}
+
+    def add(self, arc):
+        key = tuple(arc)
+        if key in self._indexes:
+            return self._indexes[key]
+        if key[::-1] in self._indexes:
+            return ~self._indexes[key[::-1]]
+        self._indexes[key] = len(self.arcs)
+        self.arcs.append(arc)
+        return self._indexes[key]
+
+def to_topojson(features, object_name, quantization=100000):
+    '''
+    Converts GeoJSON features into a TopoJSON topology, in which the
+    borders shared by features are stored once as arcs, with delta
+    encoded integer coordinates on a quantization x quantization grid.
+    Rings that collapse into fewer than three points on the grid are
+    dropped.
+    '''
+    coordinates = [
+        point
+        for feature in features
+        for polygon in polygons(feature["geometry"])
+        for ring in polygon
+        for point in ring
+    ]
+    if not coordinates:
+        xs, ys = [0], [0]
+    else:
+        xs, ys = [p[0] for p in coordinates], [p[1] for p in coordinates]
+    x0, y0 = min(xs), min(ys)
+    kx = (max(xs) - x0) / (quantization - 1) or 1
+    ky = (max(ys) - y0) / (quantization - 1) or 1
+
+    def quantize(ring):
+        return open_ring([(round((x - x0) / kx), round((y - y0) / ky)) for x, y, *_ in ring])
+
+    quantized_features = []
+    for feature in features:
+        feature_polygons = []
+        for polygon in polygons(feature["geometry"]):
+            rings = [quantize(ring) for ring in polygon]
+            if len(rings[0])<3:
+                continue
+            feature_polygons.append([ring for ring in rings if len(ring)>=3])
+        quantized_features.append((feature, feature_polygons))
+
+    junctions = find_junctions([
+        ring
+        for _, feature_polygons in quantized_features
+        for polygon in feature_polygons
+        for ring in polygon
+    ])
+
+    index = ArcIndex()
+    geometries = []
+    for feature, feature_polygons in quantized_features:
+        arcs = [
+            [[index.add(arc) for arc in split_ring(ring, junctions)] for ring in polygon]
+            for polygon in feature_polygons
+        ]
+        geometry = {"properties": feature.get("properties") or {}}
+        if not arcs:
+            geometry["type"] = None
+        elif len(arcs)==1:
+            geometry.update(type="Polygon", arcs=arcs[0])
+        else:
+            geometry.update(type="MultiPolygon", arcs=arcs)
+        geometries.append(geometry)
+
+    encoded_arcs = []
+    for arc in index.arcs:
+        encoded = [list(arc[0])]
+        for (px, py), (x, y) in zip(arc, arc[1:]):
+            encoded.append([x - px, y - py])
+        encoded_arcs.append(encoded)
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": [kx, ky], "translate": [x0, y0]},
+        "objects": {object_name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": encoded_arcs,
+    }
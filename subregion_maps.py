@@ -0,0 +1,48 @@
+import json
+import os
+import threading
+
+MAP_DIR = "source_files/geojsons/subregions/"
+MANIFEST_FILE = MAP_DIR + "manifest.json"
+
+# pre-compressed variants written by generate_subregion_maps, in order
+# of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+_lock = threading.Lock()
+_manifest = {}
+_loaded_mtime = None
+
+def _entry(region_id):
+    # {"version": content hash, "filename": GeoJSON or TopoJSON file}
+    global _manifest, _loaded_mtime
+    try:
+        mtime = os.path.getmtime(MANIFEST_FILE)
+    except FileNotFoundError:
+        return None
+    with _lock:
+        if _loaded_mtime!=mtime:
+            with open(MANIFEST_FILE) as f:
+                _manifest = json.load(f)
+            _loaded_mtime = mtime
+        return _manifest.get(region_id)
+
+def version(region_id):
+    '''
+    Returns the content hash of the region's subregion map as listed
+    in the manifest, or None if no map was generated for it. The
+    manifest is reloaded whenever the map generator rewrites it.
+    '''
+    entry = _entry(region_id)
+    return entry["version"] if entry else None
+
+def variant(region_id, accept_encodings):
+    '''
+    Returns (filepath, content encoding) of the smallest available
+    variant of the map accepted by the client.
+    '''
+    filepath = MAP_DIR + _entry(region_id)["filename"]
+    for encoding, extension in ENCODINGS:
+        if encoding in accept_encodings and os.path.exists(filepath + extension):
+            return filepath + extension, encoding
+    return filepath, None
@@ -3,6 +3,7 @@ import inspect
 import os
 
 from config import Tenant
+from models import CaseEntry
 
 all_tenants = []
 domain_map = {}
@@ -14,6 +15,12 @@ for filename in os.listdir("tenants"):
         obj = getattr(module, obj_name)
         if inspect.isclass(obj) and issubclass(obj, Tenant):
             if obj.tenant_id:
+                unknown_fields = set(obj.extra_feature_distributions) - set(CaseEntry._fields)
+                if unknown_fields:
+                    raise ValueError(
+                        f'{obj.tenant_id}: extra_feature_distributions are not '
+                        f'case entry fields: {", ".join(sorted(unknown_fields))}'
+                    )
                 all_tenants.append(obj)
                 for domain in obj.domains:
                     domain_map[domain] = obj
@@ -0,0 +1,34 @@
+import threading
+
+from cachetools import TTLCache
+
+import config
+import generations
+from models import User
+
+_lock = threading.Lock()
+_users = TTLCache(maxsize=10000, ttl=config.USER_CACHE_TTL_SECONDS)
+_loaded_generation = None
+
+def get_by_jwt(access_token, tenant_id):
+    '''
+    Cached version of User.get_by_jwt. Users are cached per worker for
+    a short while, and dropped from all workers whenever a user is
+    added, deleted or has their permissions changed, which bumps the
+    'users' generation marker.
+    '''
+    global _loaded_generation
+    generation = generations.get("users")
+    key = (access_token, tenant_id)
+    with _lock:
+        if _loaded_generation!=generation:
+            _users.clear()
+            _loaded_generation = generation
+        if key in _users:
+            return _users[key]
+
+    user = User.get_by_jwt(access_token, tenant_id)
+    with _lock:
+        if _loaded_generation==generation:
+            _users[key] = user
+    return user
@@ -0,0 +1,51 @@
+import threading
+
+from mongoengine import Q
+
+import generations
+from models import SourceFile
+
+_lock = threading.Lock()
+_active_import_ids = []
+_legacy_filenames = []
+_loaded_generation = None
+
+def _load():
+    global _active_import_ids, _legacy_filenames, _loaded_generation
+    generation = generations.get("sources")
+    with _lock:
+        if _loaded_generation!=generation:
+            _active_import_ids = SourceFile.objects().distinct("import_ids")
+            # files imported before import ids were introduced
+            _legacy_filenames = SourceFile.objects(
+                Q(import_ids__exists=False) | Q(import_ids__size=0),
+                data_type__in = ["case_data", "serotype"],
+            ).distinct("name")
+            _loaded_generation = generation
+        return _active_import_ids, _legacy_filenames
+
+def active_import_ids():
+    '''
+    Returns the import ids listed under all source files. These are
+    cached per process, and reloaded whenever an import or deletion
+    bumps the 'sources' generation marker.
+    '''
+    return _load()[0]
+
+def visible(import_ids=None):
+    '''
+    Raw query filter matching the case or serotype records that are
+    visible, either across all files or under the given import ids.
+    Across all files, the records of files imported before import ids
+    were introduced are visible as well, until they are migrated.
+    '''
+    legacy_filenames = []
+    if import_ids is None:
+        import_ids, legacy_filenames = _load()
+    query = {
+        "import_id": {"$in": list(import_ids)},
+        "superseded_by": {"$nin": list(import_ids)},
+    }
+    if legacy_filenames:
+        query = {"$or": [query, {"import_id": None, "source_filename": {"$in": legacy_filenames}}]}
+    return query